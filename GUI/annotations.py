@@ -0,0 +1,130 @@
+import numpy as np
+import zipfile, json, os, pickle
+
+'''
+# chunked annotation files
+
+An annotation file is a zip archive of .npy arrays (readable with np.load):
+    header_<seq>.npy            JSON (as uint8) with the objects metadata and, for every object,
+                                the name of the chunk holding its points in every phase
+    chunk_<seq>_<n>.npy         (n_points,4) x,y,z,t coordinates of one object in one phase
+
+Every save writes a new file (replacing the previous one once complete) with a new header, where only
+the chunks of the (object, phase) edited since the previous save are new; the others are copied.
+'''
+
+FORMAT_VERSION = 1
+
+def writeArray(zf, name, array):
+    with zf.open(name+'.npy', 'w') as f:
+        np.lib.format.write_array(f, np.ascontiguousarray(array), allow_pickle=False)
+
+def readArray(zf, name):
+    with zf.open(name+'.npy') as f:
+        return np.lib.format.read_array(f, allow_pickle=False)
+
+def latestHeader(zf):
+    names = [ n[:-4] for n in zf.namelist() if n.startswith('header_') ]
+    if len(names) == 0:
+        return None
+    header = json.loads(readArray(zf, max(names)).tobytes().decode('utf-8'))
+    assert header['version'] <= FORMAT_VERSION, 'Annotation file written by a newer version!'
+    return header
+
+def save(file_name, points):
+    '''
+    Save PointObjects to file_name and return the sequence number of the new header. The file is
+    written to a temporary file which then replaces file_name, so that an interrupted save never
+    damages the previous one. If points were already saved to the same file, only the (object, phase)
+    chunks edited since then are encoded, the others are copied as they are.
+    '''
+    incremental = (file_name in points.savedTo) and os.path.exists(file_name)
+    old = zipfile.ZipFile(file_name) if incremental else None
+    tmp_name = file_name+'.tmp'
+    try:
+        header = latestHeader(old) if incremental else None
+        seq = header['seq']+1 if header is not None else 1
+        existing = set(old.namelist()) if incremental else set()
+        objects = []
+        saved = []          # (version, chunk name) of every phase of every object, once written
+        n_chunks = 0
+        with zipfile.ZipFile(tmp_name, 'w') as zf:
+            for i, column in enumerate( points.columns ):
+                previous = column.saved.get(file_name, {}) if incremental else {}
+                saved.append({})
+                chunks = {}
+                for t in sorted(column.phaseIndex):
+                    if len(column.phaseIndex[t]) == 0:
+                        continue
+                    (version, name) = previous.get(t, (None, None))
+                    if (version == column.versions[t]) and (name+'.npy' in existing):
+                        zf.writestr(old.getinfo(name+'.npy'), old.read(name+'.npy'))
+                    else:
+                        name = 'chunk_%06d_%d'%(seq,n_chunks)
+                        writeArray(zf, name, column.phase(t))
+                        n_chunks += 1
+                    saved[i][t] = (column.versions[t], name)
+                    chunks[str(t)] = name
+                objects.append({ '_id': points.info['_ids'][i], 'color': points.info['colors'][i],
+                                'marker': points.info['markers'][i], 'ms': points.info['ms'][i],
+                                'chunks': chunks })
+            header = { 'version': FORMAT_VERSION, 'seq': seq, 'objects': objects }
+            writeArray(zf, 'header_%06d'%seq, np.frombuffer(json.dumps(header).encode('utf-8'), dtype=np.uint8))
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+    finally:
+        if old is not None:
+            old.close()
+    os.replace(tmp_name, file_name)
+
+    # the chunks are only recorded once the file was replaced
+    for column, s in zip(points.columns, saved):
+        column.saved[file_name] = s
+    points.savedTo.add(file_name)
+    return seq
+
+def load(file_name, objects=None, phases=None):
+    '''
+    Load an annotation file as an objects dictionary. Only the chunks of the objects
+    (list of ids) and phases (list of ints) requested are read; all of them by default.
+    '''
+    with zipfile.ZipFile(file_name) as zf:
+        header = latestHeader(zf)
+        meta = {'_ids': [], 'colors': [], 'markers': [], 'ms': [], 'is_instance': [], 'coords': []}
+        for o in header['objects']:
+            if (objects is not None) and (o['_id'] not in objects):
+                continue
+            chunks = { int(t): name for t, name in o['chunks'].items() if (phases is None) or (int(t) in phases) }
+            arrays = [ readArray(zf, chunks[t]) for t in sorted(chunks) ]
+            coords = np.concatenate(arrays) if len(arrays) > 0 else np.array([])
+            meta['_ids'].append(o['_id'])
+            meta['colors'].append(o['color'])
+            meta['markers'].append(o['marker'])
+            meta['ms'].append(o['ms'])
+            meta['is_instance'].append(int(coords.shape[0] > 0))
+            meta['coords'].append(coords)
+    return meta
+
+def convertPickle(p_file, file_name=None):
+    '''
+    Convert a pickle points file (any of the formats saved by previous versions) to an annotation file.
+    '''
+    import objects as obj
+    import utils as ut
+    meta = pickle.load(open(p_file,'rb'))
+    if 'coords' not in meta:
+        meta = ut.convertPoints(meta)
+    if file_name is None:
+        file_name = os.path.splitext(p_file)[0]+'.npz'
+    save(file_name, obj.PointObjects(meta))
+    return file_name
+
+if __name__ == '__main__':
+
+    import sys, glob
+
+    p_files = sys.argv[1:] if len(sys.argv) > 1 else glob.glob('../test_unwrap_heart/*.p')
+    for p_file in p_files:
+        print('Converting', p_file, '->', convertPickle(p_file))
@@ -0,0 +1,225 @@
+import numpy as np
+import threading, queue, json, os, pickle, time, zipfile
+import objects as obj
+import annotations as an
+
+'''
+# autosave journal of the annotation sessions
+'''
+
+def autosaveNames(image_name):
+    # snapshot and journal files, next to the image
+    base = os.path.splitext(image_name)[0]
+    return base+'_autosave.npz', base+'_autosave.jsonl'
+
+def hasAutosave(image_name):
+    return os.path.exists(autosaveNames(image_name)[0])
+
+def copyMeta(meta):
+    out = { key: list(value) for key, value in meta.items() }
+    out['coords'] = [ np.array(c, copy=True) for c in meta['coords'] ]
+    return out
+
+def readGeneration(snapshot_name):
+    with zipfile.ZipFile(snapshot_name) as zf:
+        return int(an.readArray(zf, 'autosave')[0])
+
+def clickOrder(column):
+    # click order position of every point of a PointColumn, in the order annotations.save writes
+    # them (grouped by phase)
+    position = np.cumsum(column.alive[:column.size])-1
+    rows = [ column.phaseIndex[t] for t in sorted(column.phaseIndex) if len(column.phaseIndex[t]) > 0 ]
+    return position[np.concatenate(rows)] if len(rows) > 0 else np.zeros(0, dtype=int)
+
+def loadSnapshot(snapshot_name):
+    # objects dictionary of a snapshot, with the points back in click order (which the ordinals
+    # of the journaled edits refer to)
+    meta = an.load(snapshot_name)
+    with zipfile.ZipFile(snapshot_name) as zf:
+        for i, coords in enumerate( meta['coords'] ):
+            if coords.shape[0] > 0:
+                order = an.readArray(zf, 'autosave_order_%d'%i)
+                meta['coords'][i] = coords[np.argsort(order, kind='stable')]
+    return meta
+
+def setAside(image_name):
+    '''
+    Renames the autosave files of image_name (e.g. when they can't be recovered), so that
+    a new session doesn't overwrite them. Returns the new file names.
+    '''
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    names = []
+    for name in autosaveNames(image_name):
+        if os.path.exists(name):
+            (base, ext) = os.path.splitext(name)
+            os.replace(name, '%s_%s%s'%(base, stamp, ext))
+            names.append('%s_%s%s'%(base, stamp, ext))
+    return names
+
+def recover(image_name):
+    '''
+    Objects dictionary autosaved for image_name: the latest snapshot, plus the edits journaled since.
+    '''
+    snapshot_name, journal_name = autosaveNames(image_name)
+    points = obj.PointObjects(loadSnapshot(snapshot_name))
+    if os.path.exists(journal_name):
+        with open(journal_name) as f:
+            lines = f.readlines()
+        # the journal only applies to the snapshot it was started from
+        if (len(lines) > 0) and (json.loads(lines[0])['generation'] == readGeneration(snapshot_name)):
+            for line in lines[1:]:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last edit only partially written
+                    break
+                points.applyEdit( (record['action'], record['idx'], np.array(record['coords']), record['ordinals']) )
+    return points.meta
+
+class Autosave():
+    '''
+    Background thread persisting an annotation session.
+    Every edit returned by PointObjects.updatePoints is appended to a journal, which is compacted
+    into a snapshot every `every` edits (or after `idle` seconds without edits). The thread keeps
+    its own copy of the points, so that it never reads objects the interface is changing, and
+    also writes the files saved by the user, so that saving never blocks the interface.
+    Failures are reported to onError(action, message), called from the background thread.
+    If not enabled, the thread only writes the files saved by the user, and never touches the
+    snapshot and journal.
+    '''
+    def __init__(self, image_name, meta, dirty=False, every=200, idle=30., onError=None, enabled=True):
+        self.snapshot_name, self.journal_name = autosaveNames(image_name)
+        self.enabled = enabled
+        self.every = every
+        self.idle = idle
+        self.onError = onError
+        self.changes = int(dirty) # number of changes recorded by the interface
+        self.saved = 0            # number of changes written to a file saved by the user
+        self.failing = False      # autosave failed (e.g. read-only image folder): reported once
+        self.journal = None
+        self.jobs = queue.Queue()
+        self.reset(meta, dirty)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    #%% called from the interface
+
+    @property
+    def dirty(self):
+        # edits not saved by the user yet (or whose save failed)
+        return self.saved != self.changes
+
+    def record(self, edit):
+        if edit is not None:
+            self.changes += 1
+            self.jobs.put( ('edit', edit) )
+
+    def reset(self, meta, dirty=True):
+        # new set of objects (loaded, or edited in the object editor)
+        if dirty:
+            self.changes += 1
+        self.jobs.put( ('reset', copyMeta(meta)) )
+
+    def saveAs(self, file_name):
+        # all the changes recorded so far are saved, once the file is written
+        self.jobs.put( ('save', (file_name, self.changes)) )
+
+    def close(self):
+        # the autosave is only kept if some edits were not saved by the user: this is decided
+        # by the thread, after the saves still queued are written
+        self.jobs.put( ('close', None) )
+        self.thread.join()
+
+    #%% background thread
+
+    def run(self):
+        n_edits = 0
+        while True:
+            try:
+                (action, arg) = self.jobs.get(timeout=self.idle)
+            except queue.Empty:
+                if n_edits == 0:
+                    continue
+                (action, arg) = ('snapshot', None)
+            try:
+                if action == 'snapshot':
+                    self.snapshot()
+                    n_edits = 0
+                elif action == 'edit':
+                    self.points.applyEdit(arg)
+                    self.write(arg)
+                    n_edits += 1
+                    if n_edits >= self.every:
+                        self.snapshot()
+                        n_edits = 0
+                elif action == 'reset':
+                    self.points = obj.PointObjects(arg)
+                    self.snapshot()
+                    n_edits = 0
+                elif action == 'save':
+                    (file_name, changes) = arg
+                    self.save(file_name)
+                    self.saved = changes
+                elif action == 'close':
+                    if self.journal is not None:
+                        self.journal.close()
+                    if not self.enabled:
+                        return
+                    if not self.dirty:
+                        for name in [self.snapshot_name, self.journal_name]:
+                            if os.path.exists(name):
+                                os.remove(name)
+                    elif n_edits > 0:
+                        self.snapshot()
+                        self.journal.close()
+                    return
+            except Exception as e:
+                # the saves asked by the user are always reported, autosave failures only until
+                # a snapshot succeeds again
+                if (action == 'save') or (not self.failing):
+                    if self.onError is not None:
+                        self.onError(action, str(e))
+                    else:
+                        print('Warning: autosave (%s) failed:'%action, e)
+                if action != 'save':
+                    self.failing = True
+                if action == 'close':
+                    return
+
+    def write(self, edit):
+        if self.journal is None:
+            # no snapshot could be written yet: journaling is off until one is
+            return
+        (action, idx, coords, ordinals) = edit
+        self.journal.write(json.dumps({'action': action, 'idx': int(idx), 'coords': np.asarray(coords).tolist(),
+                                        'ordinals': [int(o) for o in ordinals]})+'\n')
+        self.journal.flush()
+
+    def snapshot(self):
+        # write the snapshot and start an empty journal; each file is replaced atomically
+        if not self.enabled:
+            return
+        generation = time.time_ns()
+        tmp_name = self.snapshot_name+'.tmp'
+        an.save(tmp_name, self.points)
+        with zipfile.ZipFile(tmp_name, 'a') as zf:
+            an.writeArray(zf, 'autosave', np.array([generation]))
+            for i, column in enumerate( self.points.columns ):
+                an.writeArray(zf, 'autosave_order_%d'%i, clickOrder(column))
+        os.replace(tmp_name, self.snapshot_name)
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        with open(self.journal_name+'.tmp', 'w') as f:
+            f.write(json.dumps({'generation': generation})+'\n')
+        os.replace(self.journal_name+'.tmp', self.journal_name)
+        self.journal = open(self.journal_name, 'a')
+        self.failing = False
+
+    def save(self, file_name):
+        if file_name[-4:] == '.npz':
+            an.save(file_name, self.points)
+        else:
+            with open(file_name,'wb') as f:
+                pickle.dump(self.points.meta, f)
+        print('Saved data to:\n\t', file_name)
@@ -0,0 +1,115 @@
+import numpy as np
+from matplotlib.colors import to_rgb
+import threading
+
+'''
+# LUT-based compositing of the channels of a plane
+'''
+
+class Compositor():
+    '''
+    Composites the channels of a plane (C,H,W) into an RGBA uint8 image.
+    Every channel goes through a lookup table (computed once per contrast limits) mapping
+    its values directly to packed RGBA colors, and channels are summed with saturation.
+    '''
+    def __init__(self, colors = ('aqua','red')):
+        self.colors = [ np.array(to_rgb(c)) for c in colors ]
+        self.luts = {}
+        self.lock = threading.Lock()     # the lookup tables are shared by the interface and prefetch threads
+        self.local = threading.local()
+
+    def isDirect(self, dtype):
+        # uint8 and uint16 values index the lookup table directly
+        return dtype in (np.uint8, np.uint16)
+
+    def lut(self, i, lims, dtype):
+        n = 2**(8*dtype.itemsize) if self.isDirect(dtype) else 256
+        key = (i, tuple(lims), n)
+        with self.lock:
+            lut = self.luts.get(key)
+        if lut is None:
+            (vmin, vmax) = lims
+            values = np.arange(n) if self.isDirect(dtype) else np.linspace(vmin, vmax, n)
+            if vmax > vmin:
+                frac = np.clip((values-vmin)/(vmax-vmin), 0., 1.)
+            else:
+                frac = (values > vmin).astype(float)
+            rgba = np.full((n,4), 255, dtype=np.uint8)
+            rgba[:,:3] = np.rint(frac[:,None]*self.colors[i]*255)
+            lut = rgba.view(np.uint32).ravel()
+            with self.lock:
+                if len(self.luts) > 32:
+                    self.luts.clear()
+                self.luts[key] = lut
+        return lut
+
+    def lutIndex(self, channel, lims):
+        if self.isDirect(channel.dtype):
+            return channel
+        (vmin, vmax) = lims
+        scale = 255./(vmax-vmin) if vmax > vmin else 0.
+        return np.rint((np.clip(channel, vmin, vmax)-vmin)*scale).astype(np.intp)
+
+    def scratch(self, shape):
+        # per-thread buffers, reused across frames
+        buffers = getattr(self.local, 'buffers', None)
+        if (buffers is None) or (buffers.shape[1:] != shape):
+            buffers = np.empty((2,*shape), dtype=np.uint8)
+            self.local.buffers = buffers
+        return buffers
+
+    def composite(self, planes, settings, out=None):
+        (enabled, chVal) = settings
+        shape = (*planes.shape[1:], 4)
+        if out is None:
+            out = np.empty(shape, dtype=np.uint8)
+        out[...] = 0
+        out[...,3] = 255
+        (layer, room) = self.scratch(shape)
+        first = True
+        for i, b in enumerate( enabled ):
+            if not b:
+                continue
+            lut = self.lut(i, chVal[i], planes.dtype)
+            target = out if first else layer
+            np.take(lut, self.lutIndex(planes[i], chVal[i]), out=target.view(np.uint32)[...,0], mode='clip')
+            if not first:
+                # saturated sum: out += min(layer, 255-out)
+                np.bitwise_not(out, out=room)
+                np.minimum(layer, room, out=layer)
+                np.add(out, layer, out=out)
+            first = False
+        return out
+
+if __name__ == '__main__':
+
+    # per-frame compositing time of the previous float64 colormap path and of the lookup tables
+    import time
+    from matplotlib.colors import LinearSegmentedColormap
+
+    cmaps = [ LinearSegmentedColormap.from_list('mycmap1', ['black', 'aqua'],N=2**16-1),
+                LinearSegmentedColormap.from_list('mycmap2', ['black', 'red'],N=2**16-1) ]
+    def compositeColormap(stacks, settings):
+        (enabled, chVal) = settings
+        rgba_img = np.zeros((*stacks.shape[1:],3))
+        for i, b in enumerate( enabled ):
+            if b:
+                lims = chVal[i]
+                channel = np.clip(stacks[i,...],lims[0],lims[1])
+                channel = (channel-np.min(channel))/(np.max(channel)-np.min(channel))
+                rgba_img += cmaps[i](channel)[:,:,:3]
+        return rgba_img
+
+    compositor = Compositor()
+    for size in [512, 1024, 2048]:
+        planes = np.random.randint(0, 4000, (2,size,size), dtype=np.uint16)
+        out = np.empty((size,size,4), dtype=np.uint8)
+        settings = ((True,True), ((100,3000),(200,3500)))
+        times = []
+        for f in [ lambda: compositeColormap(planes, settings), lambda: compositor.composite(planes, settings, out=out) ]:
+            f()
+            start = time.time()
+            for i in range(10):
+                f()
+            times.append( (time.time()-start)/10*1000 )
+        print('%dx%d: colormap %.1f ms/frame, lookup tables %.1f ms/frame'%(size,size,*times))
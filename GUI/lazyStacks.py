@@ -0,0 +1,189 @@
+from tifffile import TiffFile, imread, memmap
+import numpy as np
+import threading
+
+'''
+# lazy image stacks
+'''
+
+class ArrayPlanes():
+    '''
+    Planes of an array already addressable in memory (typically a np.memmap of an uncompressed tif):
+    indexing the leading axes returns a view, so only the planes which are read become resident.
+    '''
+    def __init__(self, data):
+        self.data = data
+        self.shape = tuple(data.shape)
+        self.dtype = data.dtype
+        self.plane_ndim = min(2, data.ndim)
+        self.lead_shape = self.shape[:len(self.shape)-self.plane_ndim]
+
+    def readPlane(self, idx):
+        return self.data[idx]
+
+class TiffPages():
+    '''
+    Planes of a compressed tif series: every page is decoded only when it is requested.
+    Reading is serialized, so that planes can be prefetched from a background thread.
+    '''
+    def __init__(self, file_name):
+        self.tif = TiffFile(file_name)
+        self.lock = threading.Lock()
+        series = self.tif.series[0]
+        self.pages = series.pages
+        self.shape = tuple(series.shape)
+        self.dtype = series.dtype
+        plane_shape = tuple(series.keyframe.shape)
+        self.plane_ndim = len(plane_shape)
+        self.lead_shape = self.shape[:len(self.shape)-self.plane_ndim]
+        if (self.shape[len(self.lead_shape):] != plane_shape) or (int(np.prod(self.lead_shape)) != len(self.pages)):
+            self.tif.close()
+            raise ValueError('tif pages do not map one-to-one on the image series')
+
+    def readPlane(self, idx):
+        i = np.ravel_multi_index(idx, self.lead_shape) if len(idx)>0 else 0
+        with self.lock:
+            return self.pages[int(i)].asarray()
+
+def openPlanes(file_name):
+    try:
+        return ArrayPlanes(memmap(file_name, mode='r'))
+    except ValueError:
+        pass
+    try:
+        return TiffPages(file_name)
+    except ValueError:
+        # unusual page layout: read the whole series in memory
+        return ArrayPlanes(imread(file_name))
+
+def outerIndex(sel):
+    # index selecting the outer product of sel, made of plain slices whenever possible (much faster than np.ix_)
+    if all( (len(s)>0) and np.all(np.diff(s)==1) for s in sel ):
+        return tuple( slice(s[0], s[-1]+1) for s in sel )
+    return np.ix_(*sel)
+
+class LazyStack():
+    '''
+    Read-only, array-like view on the planes of a tif file.
+    Axes can be appended, moved, flipped and padded with zeros without reading any data, and
+    indexing (e.g. stacks[t,z]) only reads the planes that are selected.
+    '''
+    def __init__(self, planes, axes=None, flipped=None, pads=None):
+        self.planes = planes
+        self._axes = list(range(len(planes.shape))) if axes is None else list(axes)
+        self._flipped = [False]*len(self._axes) if flipped is None else list(flipped)
+        self._pads = [0]*len(self._axes) if pads is None else list(pads)
+
+    @property
+    def shape(self):
+        return tuple( n+p for n, p in zip(self._baseShape(), self._pads) )
+
+    @property
+    def ndim(self):
+        return len(self._axes)
+
+    @property
+    def dtype(self):
+        return self.planes.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def _baseShape(self):
+        # length of every axis of the view, without the virtual zero padding
+        return tuple( 1 if a is None else self.planes.shape[a] for a in self._axes )
+
+    #%% view manipulation (no data is read)
+
+    def expand_dims(self, axis):
+        axis = axis % (self.ndim+1)
+        axes, flipped, pads = list(self._axes), list(self._flipped), list(self._pads)
+        axes.insert(axis, None)
+        flipped.insert(axis, False)
+        pads.insert(axis, 0)
+        return LazyStack(self.planes, axes, flipped, pads)
+
+    def transpose(self, axes):
+        return LazyStack(self.planes, [self._axes[a] for a in axes],
+                            [self._flipped[a] for a in axes], [self._pads[a] for a in axes])
+
+    def flip(self, axis):
+        flipped = list(self._flipped)
+        flipped[axis] = not flipped[axis]
+        return LazyStack(self.planes, self._axes, flipped, self._pads)
+
+    def pad(self, axis, n):
+        # append n virtual planes of zeros along axis: they are never allocated in the stack
+        pads = list(self._pads)
+        pads[axis] += n
+        return LazyStack(self.planes, self._axes, self._flipped, pads)
+
+    #%% data access
+
+    def _expandKey(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        for i, k in enumerate(key):
+            if k is Ellipsis:
+                key = key[:i] + (slice(None),)*(self.ndim-len(key)+1) + key[i+1:]
+                break
+        if len(key) > self.ndim:
+            raise IndexError('too many indices for stack of dimension %d'%self.ndim)
+        return key + (slice(None),)*(self.ndim-len(key))
+
+    def _read(self, sel):
+        # same selection along the axes of the file
+        src_sel = [ None for i in self.planes.shape ]
+        for a, s in zip(self._axes, sel):
+            if a is not None:
+                src_sel[a] = s
+        n_lead = len(self.planes.lead_shape)
+        lead, plane = src_sel[:n_lead], src_sel[n_lead:]
+        full_plane = all( np.array_equal(s, np.arange(n)) for s, n in zip(plane, self.planes.shape[n_lead:]) )
+        plane = outerIndex(plane)
+
+        # read the selected planes only
+        out = np.empty([len(s) for s in src_sel], dtype=self.dtype)
+        for pos in np.ndindex(*[len(s) for s in lead]):
+            data = self.planes.readPlane(tuple( int(s[p]) for s, p in zip(lead, pos) ))
+            out[pos] = data if full_plane else data[plane]
+
+        # back to the order of the view
+        out = out.transpose([a for a in self._axes if a is not None])
+        return out.reshape([len(s) for s in sel])
+
+    def __getitem__(self, key):
+        # indices selected along every axis of the view
+        sel, keep = [], []
+        for k, n, f in zip(self._expandKey(key), self.shape, self._flipped):
+            idx = np.arange(n)
+            if f:
+                idx = idx[::-1]
+            idx = idx[k]
+            keep.append(np.ndim(idx)>0)
+            sel.append(np.atleast_1d(idx))
+        out_shape = [len(s) for s, k in zip(sel, keep) if k]
+
+        # split real entries from the virtual zero padding
+        real = [ s<n for s, n in zip(sel, self._baseShape()) ]
+        if all( r.all() for r in real ):
+            return self._read(sel).reshape(out_shape)
+        out = np.zeros([len(s) for s in sel], dtype=self.dtype)
+        if all( r.any() for r in real ):
+            out[outerIndex([np.nonzero(r)[0] for r in real])] = self._read([ s[r] for s, r in zip(sel, real) ])
+        return out.reshape(out_shape)
+
+def adaptAxes(stacks, input_id, target_id='TZCHW'):
+    '''
+    View of stacks (with dimension ids input_id, e.g. 'ZCHW') with the axes ordered as in target_id.
+    Missing dimensions are appended as singleton axes; no data is read.
+    '''
+    for i in target_id:
+        if i not in input_id:
+            stacks = stacks.expand_dims(-1)
+            input_id = input_id+i
+    return stacks.transpose([input_id.index(i) for i in target_id])
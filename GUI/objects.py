@@ -1,60 +1,280 @@
-from tifffile import imread
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
-from PyQt5.QtWidgets import (QDialog, QSizePolicy, QApplication, QTableWidget, QVBoxLayout,
-                            QPushButton, QColorDialog, QTableWidgetItem, QMessageBox)
-from PyQt5.QtGui import QCursor, QColor
-from PyQt5.QtCore import Qt
-from matplotlib.colors import LinearSegmentedColormap
-import copy, re
-from ast import literal_eval
+import itertools
 
 '''
 # classes
 '''
 
+# unique version numbers, to tell whether the points of an object in a phase have changed
+_versions = itertools.count(1)
+
+class PointColumn():
+    '''
+    Points (x, y, z, t) of one object, in click order, stored in a growable array.
+    The rows of every (t, z) plane are indexed, and removed rows are only flagged
+    (the array is compacted when they become too many), so that adding or removing
+    a point only costs as much as the points in the same plane.
+    '''
+    def __init__(self, coords=np.array([]), capacity=64):
+        coords = np.asarray(coords, dtype=float).reshape(-1,4)
+        n = coords.shape[0]
+        self.data = np.zeros((max(capacity,2*n),4))
+        self.data[:n] = coords
+        self.alive = np.zeros(self.data.shape[0], dtype=bool)
+        self.alive[:n] = True
+        self.size = n          # rows used in self.data
+        self.count = n         # rows not removed
+        self.saved = {}        # (version, chunk name) of every phase, in every annotation file saved to
+        self.buildIndex()
+
+    def __len__(self):
+        return self.count
+
+    def buildIndex(self):
+        # rows of every (t, z) plane and of every phase t, in click order
+        self.index = {}
+        self.phaseIndex = {}
+        rows = np.nonzero(self.alive[:self.size])[0]
+        if len(rows) > 0:
+            tz = self.data[rows][:,[3,2]].astype(int)
+            keys, inverse = np.unique(tz, axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+            order = rows[np.argsort(inverse, kind='stable')]
+            order = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+            self.index = { (int(k[0]),int(k[1])): r.tolist() for k, r in zip(keys, order) }
+            for t in np.unique(tz[:,0]):
+                self.phaseIndex[int(t)] = rows[tz[:,0]==t].tolist()
+        self.versions = { t: next(_versions) for t in self.phaseIndex }
+        self._array = None
+
+    def append(self, coord):
+        if self.size == self.data.shape[0]:
+            self.data = np.concatenate([self.data, np.zeros(self.data.shape)])
+            self.alive = np.concatenate([self.alive, np.zeros(self.alive.shape, dtype=bool)])
+        row = self.size
+        self.data[row] = coord
+        self.alive[row] = True
+        self.index.setdefault((int(coord[3]),int(coord[2])), []).append(row)
+        self.phaseIndex.setdefault(int(coord[3]), []).append(row)
+        self.versions[int(coord[3])] = next(_versions)
+        self.size += 1
+        self.count += 1
+        self._array = None
+        return row
+
+    def remove(self, rows):
+        for row in rows:
+            self.alive[row] = False
+            self.index[(int(self.data[row,3]),int(self.data[row,2]))].remove(row)
+            self.phaseIndex[int(self.data[row,3])].remove(row)
+            self.versions[int(self.data[row,3])] = next(_versions)
+        self.count -= len(rows)
+        self._array = None
+        if (self.size - self.count) > max(64, self.count):
+            self.compact()
+
+    def compact(self):
+        coords = self.data[:self.size][self.alive[:self.size]]
+        self.data[:coords.shape[0]] = coords
+        self.alive[:] = False
+        self.alive[:coords.shape[0]] = True
+        self.size = self.count = coords.shape[0]
+        self.buildIndex()
+
+    def plane(self, t, z):
+        rows = self.index.get((t, z), [])
+        return self.data[rows]
+
+    def phase(self, t):
+        rows = self.phaseIndex.get(t, [])
+        return self.data[rows]
+
+    def nearest(self, coord):
+        # rows of the points in the plane of coord which are closest to it
+        rows = np.array(self.index.get((int(coord[3]),int(coord[2])), []), dtype=int)
+        if len(rows) == 0:
+            return rows
+        dist = np.linalg.norm(self.data[rows,:3]-coord[:3], axis=1)
+        return rows[dist==np.min(dist)]
+
+    def insert(self, ordinals, coords):
+        # put points back at their position (ordinals, in click order) among the points of the object
+        order = np.argsort(ordinals, kind='stable')
+        ordinals = np.asarray(ordinals, dtype=int)[order]
+        coords = np.asarray(coords, dtype=float).reshape(-1,4)[order]
+        if np.array_equal(ordinals, self.count+np.arange(len(ordinals))):
+            for coord in coords:
+                self.append(coord)
+            return
+        coords = np.insert(self.array().reshape(-1,4), ordinals-np.arange(len(ordinals)), coords, axis=0)
+        self.data = np.zeros((max(self.data.shape[0],2*coords.shape[0]),4))
+        self.data[:coords.shape[0]] = coords
+        self.alive = np.zeros(self.data.shape[0], dtype=bool)
+        self.alive[:coords.shape[0]] = True
+        self.size = self.count = coords.shape[0]
+        self.buildIndex()
+
+    def ordinals(self, rows):
+        # position of rows in click order
+        return [ int(np.count_nonzero(self.alive[:row])) for row in rows ]
+
+    def rowsAt(self, ordinals):
+        return np.nonzero(self.alive[:self.size])[0][np.asarray(ordinals, dtype=int)]
+
+    def array(self):
+        # compact (n,4) array of the points, cached until the next change
+        if self._array is None:
+            if self.count == 0:
+                self._array = np.array([])
+            else:
+                self._array = self.data[:self.size][self.alive[:self.size]]
+        return self._array
+
 class PointObjects():
     def __init__(self, points_meta):
         self.meta = points_meta        # self.meta['coords'] = [ np.array([]) for _id in points_meta['_ids'] ]
+        self.savedTo = set()           # annotation files the points were saved to
+
+    @property
+    def meta(self):
+        # objects dictionary, with the coords of every object as a compact array (e.g. for saving)
+        self.info['coords'] = [ c.array() for c in self.columns ]
+        return self.info
+
+    @meta.setter
+    def meta(self, points_meta):
+        # self.info holds the objects metadata: its 'coords' entry is only refreshed by self.meta
+        self.info = points_meta
+        self.columns = [ PointColumn(c) for c in points_meta['coords'] ]
+        self.updatePointMeta()
 
     def updatePoints(self, current_id, coord, event):
         # print('Mouse clicked! ', event)
-        current_idx = self.meta['_ids'].index(current_id)
-        points = self.meta['coords'][current_idx]
-        _idxs = np.arange(points.shape[0])
+        # returns the edit as (action, object index, coords of the points added/removed, their ordinals), or None
+        current_idx = self.info['_ids'].index(current_id)
+        column = self.columns[current_idx]
+        edit = None
 
         # LEFT CLICK: add point
         if event.button == 1:
-            if points.shape[0]!=0:
-                self.meta['coords'][current_idx] = np.append(self.meta['coords'][current_idx],np.array([coord]),axis=0)
-            else:
-                self.meta['coords'][current_idx] = np.array([coord])
+            edit = ('add', current_idx, np.array([coord]), [len(column)])
+            column.append(coord)
 
-        # RIGHT CLICK: remove point from the same contraction phase and focal plane
+        # RIGHT CLICK: remove the closest point from the same contraction phase and focal plane
         if event.button == 3:
-            new_points = []
-            new_idxs = []
-            for i, p in enumerate(points): # filter only points in the same focal plane and contraction phase
-                if p[2] == coord[2]: # same focal plane
-                    if p[3] == coord[3]: # same contraction phase
-                        new_points.append(p) # save the poiont
-                        new_idxs.append(i)   # save the original index
-            points = np.array(new_points)
-            _idxs = np.array(new_idxs)
-
-            # now find the closest point to the click and remove it
-            if len(_idxs) != 0:
-                dist = [ np.linalg.norm(coord[:3]-c1) for c1 in points[:,:3] ]
-                i = np.where(dist==np.min(dist))[0]
-                self.meta['coords'][current_idx] = np.delete(self.meta['coords'][current_idx], _idxs[i], axis=0)
+            rows = column.nearest(coord)
+            if len(rows) > 0:
+                edit = ('remove', current_idx, column.data[rows], column.ordinals(rows))
+                column.remove(rows)
 
         self.updatePointMeta()
+        return edit
     
+    def applyEdit(self, edit):
+        # replay an edit returned by updatePoints
+        (action, idx, coords, ordinals) = edit
+        column = self.columns[idx]
+        if action == 'add':
+            column.insert(ordinals, coords)
+        if action == 'remove':
+            column.remove(column.rowsAt(ordinals))
+        self.updatePointMeta()
+
+    def state(self):
+        # objects metadata, and their columns by reference
+        info = { key: list(value) for key, value in self.info.items() if key != 'coords' }
+        return (info, list(self.columns))
+
+    def setState(self, state):
+        (info, columns) = state
+        self.info = { key: list(value) for key, value in info.items() }
+        self.columns = list(columns)
+        self.info['coords'] = [ c.array() for c in self.columns ]
+        self.updatePointMeta()
+
+    def updateObjects(self, points_meta, origins):
+        # new objects dictionary, where origins[i] is the index of the object the i-th one was edited
+        # from (or None for new objects): edited objects keep their column
+        self.columns = [ PointColumn() if o is None else self.columns[o] for o in origins ]
+        self.info = points_meta
+        self.info['coords'] = [ c.array() for c in self.columns ]
+        self.updatePointMeta()
+
     def updatePointMeta(self):
-        for i, ps in enumerate( self.meta['coords'] ):
-            if ps.shape[0]>0:
-                self.meta['is_instance'][i] = 1
+        for i, c in enumerate( self.columns ):
+            if len(c)>0:
+                self.info['is_instance'][i] = 1
             else:
-                self.meta['is_instance'][i] = 0
+                self.info['is_instance'][i] = 0
+
+    def planeCoords(self, i, t, z):
+        return self.columns[i].plane(t, z)
+
+class History():
+    '''
+    Undo and redo stacks of the edits of PointObjects, stored as deltas: point edits (as returned
+    by updatePoints) and object edits ('objects', state before, state after), whose states share
+    the columns by reference. Memory grows with the number of edits, not with the points.
+    '''
+    def __init__(self):
+        self.done = []
+        self.undone = []
+
+    def push(self, delta):
+        if delta is not None:
+            self.done.append(delta)
+            self.undone.clear()
+
+    def inverse(self, delta):
+        if delta[0] == 'objects':
+            return ('objects', delta[2], delta[1])
+        (action, idx, coords, ordinals) = delta
+        return ('remove' if action == 'add' else 'add', idx, coords, ordinals)
+
+    def apply(self, points, delta):
+        if delta[0] == 'objects':
+            points.setState(delta[2])
+        else:
+            points.applyEdit(delta)
+        return delta
+
+    def undo(self, points):
+        # returns the delta applied to points, or None
+        # the delta only moves to the other stack once it was applied
+        if len(self.done) == 0:
+            return None
+        delta = self.done[-1]
+        applied = self.apply(points, self.inverse(delta))
+        self.undone.append(self.done.pop())
+        return applied
+
+    def redo(self, points):
+        if len(self.undone) == 0:
+            return None
+        delta = self.undone[-1]
+        applied = self.apply(points, delta)
+        self.done.append(self.undone.pop())
+        return applied
+
+class PointsView():
+    '''
+    Read-only view on PointObjects, optionally restricted to one contraction phase.
+    The points of every (object, phase) are only gathered when they are asked for,
+    and version() tells whether they changed since the last time.
+    '''
+    def __init__(self, points, phase=None):
+        self.points = points
+        self.info = points.info
+        self.phase = phase
+
+    def phases(self, n_ph):
+        return range(n_ph) if self.phase is None else [self.phase]
+
+    def count(self, i, ph):
+        return len(self.points.columns[i].phaseIndex.get(ph, []))
+
+    def version(self, i, ph):
+        return self.points.columns[i].versions.get(ph, 0)
+
+    def phaseCoords(self, i, ph):
+        return self.points.columns[i].phase(ph)
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+import threading
+
+'''
+# cache of composited planes
+'''
+
+class PlaneCache():
+    '''
+    LRU cache of composited planes with a memory budget (in bytes).
+    Keys are (t, z, settings); clear() starts a new generation, so that planes
+    computed in the background from a previous stack are dropped.
+    '''
+    def __init__(self, budget=256*2**20):
+        self.budget = budget
+        self.planes = OrderedDict()
+        self.nbytes = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.planes.clear()
+            self.nbytes = 0
+            self.generation += 1
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.planes
+
+    def get(self, key):
+        with self.lock:
+            plane = self.planes.get(key)
+            if plane is not None:
+                self.planes.move_to_end(key)
+            return plane
+
+    def put(self, key, plane, generation=None):
+        with self.lock:
+            if (generation is not None) and (generation != self.generation):
+                return
+            if key in self.planes:
+                self.nbytes -= self.planes.pop(key).nbytes
+            self.planes[key] = plane
+            self.nbytes += plane.nbytes
+            # evict the least recently used planes
+            while (self.nbytes > self.budget) and (len(self.planes) > 1):
+                _, old = self.planes.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+class Prefetcher():
+    '''
+    Background thread compositing the planes around the current (t,z) position into the cache.
+    composite(plane, settings) must not touch any Qt widget.
+    '''
+    def __init__(self, cache, composite, steps = ((0,1),(0,-1),(1,0),(-1,0),(0,2),(0,-2))):
+        self.cache = cache
+        self.composite = composite
+        self.steps = steps
+        self.jobs = []
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def request(self, stacks, t, z, settings):
+        # replace whatever is still pending with the neighbours of the current position
+        generation = self.cache.generation
+        jobs = []
+        for (dt, dz) in self.steps:
+            if (0 <= t+dt < stacks.shape[0]) and (0 <= z+dz < stacks.shape[1]):
+                jobs.append( (stacks, t+dt, z+dz, settings, generation) )
+        with self.condition:
+            self.jobs = jobs
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.jobs) == 0:
+                    self.condition.wait()
+                (stacks, t, z, settings, generation) = self.jobs.pop(0)
+            key = (t, z, settings)
+            if key in self.cache:
+                continue
+            try:
+                plane = self.composite(stacks[t,z], settings)
+            except Exception as e:
+                print('Warning: prefetching plane (t=%d, z=%d) failed:'%(t,z), e)
+                continue
+            self.cache.put(key, plane, generation)
@@ -1,22 +1,19 @@
-from PyQt5.QtGui import QCursor, QPixmap, QColor,QPainter
-from PyQt5.QtCore import QDateTime, Qt, QTimer, QSize
-from PyQt5.QtWidgets import (QApplication, QCheckBox, QComboBox, QDateTimeEdit,
-        QDial, QDialog, QGridLayout, QGroupBox, QHBoxLayout, QLabel, QLineEdit,
-        QProgressBar, QPushButton, QRadioButton, QScrollBar, QSizePolicy,
-        QSlider, QSpinBox, QStyleFactory, QTableWidget, QTabWidget, QTextEdit,
-        QVBoxLayout, QWidget, QFileDialog, QMessageBox, QErrorMessage, QSplitter)
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
-import matplotlib.pyplot as plt
+from PyQt5.QtGui import QKeySequence
+from PyQt5.QtCore import Qt, QSize, pyqtSignal
+from PyQt5.QtWidgets import (QApplication, QCheckBox, QComboBox,
+        QDialog, QGridLayout, QGroupBox, QHBoxLayout, QLabel,
+        QPushButton, QSizePolicy,
+        QSlider, QSpinBox,
+        QVBoxLayout, QFileDialog, QMessageBox, QSplitter, QShortcut)
 import numpy as np
-from mpl_toolkits.mplot3d import Axes3D
-from tifffile import imread
-import pandas as pd
-import os, pickle, time, copy
+import pickle, time
 import utils as ut
 import subWindows as sw
 import subClasses as sc
 import objects as obj
+import planeCache as pc
+import annotations as an
+import autosave as au
 
 class dimensionGUI(QDialog):
     def __init__(self, parent=None):
@@ -51,6 +48,9 @@ class dimensionGUI(QDialog):
         self.m.exec()
 
 class MyGUI(QDialog):
+    # failures of the autosave thread (action, message), shown in the interface thread
+    autosaveFailed = pyqtSignal(str, str)
+
     def __init__(self, h, v, parent=None):
         super(MyGUI, self).__init__(parent)
 
@@ -64,12 +64,19 @@ class MyGUI(QDialog):
         self.stacks = np.zeros((3,3,2,v,h))
         self.channels = ['ch0', 'ch1']
         self.widgets = {}
+        self.planeCache = pc.PlaneCache()
+        self.autosave = None
+        self.autosaveFailed.connect(self.showAutosaveError)
+        self.history = obj.History()
 
         self.createLoadSaveGroupBox()
         self.createObjectsControlGroupBox()
         self.createTZCControlGroupBox()
         self.createCanvas2DGroupBox()
         self.createCanvas3DGroupBox()
+        self.prefetcher = pc.Prefetcher(self.planeCache, self.widgets['groupCanvas2D'][2].composite)
+        QShortcut(QKeySequence.Undo, self, self.undo)
+        QShortcut(QKeySequence.Redo, self, self.redo)
 
         self.setEnableState(False)
 
@@ -241,6 +248,8 @@ class MyGUI(QDialog):
         if new_file != '':
             self.file_name = new_file
             self.stacks, self._maxval = ut.loadStacks5D(self.file_name, app=True)
+            self.planeCache.clear()
+            self.startAutosave()
             self.setEnableState(True)
             (t, z, c) = self.getTZC()
 
@@ -254,7 +263,7 @@ class MyGUI(QDialog):
             self.TLabel.setText("&Time\n(0-%s)"%str(self.stacks.shape[0]-1))
             self.ZLabel.setText("&Z plane\n(0-%s)"%str(self.stacks.shape[1]-1))
 
-            self.widgets['groupCanvas3D'][0].plot(self.points.meta,self.stacks.shape[0])
+            self.widgets['groupCanvas3D'][0].plot(obj.PointsView(self.points),self.stacks.shape[0])
 
             for i in range(self.stacks.shape[2]):
                 self.widgets['groupTZC'][i+3].setChecked(True)
@@ -262,37 +271,77 @@ class MyGUI(QDialog):
                 self.widgets['groupTZC'][2].setCurrentIndex(i)
                 self.updateBCslider()
             self.updateCanvas2D()
-            self.widgets['groupCanvas3D'][3].populateTable(meta=self.points.meta, n_ph=self.stacks.shape[0])
+            # the objects may have been recovered from the autosave
+            self.refreshObjects()
 
     def selectPointsFile(self):
         new_file,_ = QFileDialog.getOpenFileName(self, "Select Merged File")
         if new_file != '':
-            if new_file.split('.')[-1] not in ['p','pickle']:
-                QMessageBox.warning(self,'Warning, invalid input file!','Only pickle file implemented so far:\n please choose a valid \".p\" file')
+            if new_file.split('.')[-1] not in ['npz','p','pickle']:
+                QMessageBox.warning(self,'Warning, invalid input file!','Only annotation and pickle files are implemented so far:\n please choose a valid \".npz\" or \".p\" file')
             else:
-                self.points.meta = pickle.load(open(new_file,'rb'))
-                (t, z, c) = self.getTZC()
-                try:
-                    self.widgets['groupCanvas2D'][2].updateScatter(t, z, self.points.meta)
-                except:
-                    self.points.meta = ut.convertPoints(self.points.meta)
-                self.widgets['groupCanvas2D'][2].updateScatter(t, z, self.points.meta)
-                self.updateCanvas3D()
-                self.widgets['groupCanvas3D'][3].populateTable(meta=self.points.meta,n_ph=self.stacks.shape[0])
+                before = self.points.state()
+                if new_file.split('.')[-1] == 'npz':
+                    self.points.meta = an.load(new_file)
+                else:
+                    meta = pickle.load(open(new_file,'rb'))
+                    if 'coords' not in meta:
+                        meta = ut.convertPoints(meta)
+                    self.points.meta = meta
+                self.history.push( ('objects', before, self.points.state()) )
+                self.autosave.reset(self.points.meta, dirty=False)
+                self.refreshObjects()
 
     def saveData(self):
         save_file_name, _ = QFileDialog.getSaveFileName(self,"Save file")
         if save_file_name != '':
-            if (save_file_name[-2:]=='.p') and (len(save_file_name)>2):
+            if ((save_file_name[-4:]=='.npz') and (len(save_file_name)>4)) or ((save_file_name[-2:]=='.p') and (len(save_file_name)>2)):
+                # written in the background by the autosave thread
                 print('#'*40)
                 print('Saving data to:\n\t', save_file_name)
-                pickle.dump(self.points.meta,open(save_file_name,'wb'))
-                print('Done')
+                self.autosave.saveAs(save_file_name)
             else:
-                QMessageBox.warning(self,'Warning, invalid file name!','Only pickle file saving is implemented so far:\n please chose a \".p\" file name')
+                QMessageBox.warning(self,'Warning, invalid file name!','Only annotation and pickle file saving are implemented so far:\n please chose a \".npz\" or \".p\" file name')
+
+    def startAutosave(self):
+        if self.autosave is not None:
+            self.autosave.close()
+        # the edits of the previous image (or session) can't be undone on this one
+        self.history = obj.History()
+        recovered = False
+        enabled = True
+        if au.hasAutosave(self.file_name):
+            answer = QMessageBox.question(self, 'Recover points?', 'Points not saved in a previous session were found for this image.\nDo you want to recover them?')
+            if answer == QMessageBox.Yes:
+                try:
+                    self.points.meta = au.recover(self.file_name)
+                    recovered = True
+                except Exception as e:
+                    # the autosave files are the only copy of those points: never overwrite them
+                    try:
+                        names = au.setAside(self.file_name)
+                        QMessageBox.warning(self, 'Warning, recovery failed!', '%s\n\nThe autosave files were kept as:\n%s'%(e, '\n'.join(names)))
+                    except OSError:
+                        enabled = False
+                        QMessageBox.warning(self, 'Warning, recovery failed!', '%s\n\nThe autosave files are kept, and autosave is off for this session.'%e)
+        self.autosave = au.Autosave(self.file_name, self.points.meta, dirty=recovered, onError=self.autosaveFailed.emit, enabled=enabled)
+
+    def showAutosaveError(self, action, message):
+        if action == 'save':
+            QMessageBox.warning(self, 'Warning, saving failed!', 'The points were not saved:\n%s\n\nThey are still autosaved next to the image.'%message)
+        else:
+            QMessageBox.warning(self, 'Warning, autosave failed!', 'Autosave (%s) failed, unsaved points can\'t be recovered after a crash:\n%s\n\nThis is only reported once.'%(action, message))
+
+    def done(self, r):
+        if self.autosave is not None:
+            self.autosave.close()
+            self.autosave = None
+        self.history = obj.History()
+        super(MyGUI, self).done(r)
 
     def swapColors(self):
         self.stacks, self._maxval = ut.swapAxes( self.stacks, self._maxval, ax=2 )
+        self.planeCache.clear()
         self.updateCanvas2D()
 
     def setEnableState(self, state):
@@ -303,33 +352,36 @@ class MyGUI(QDialog):
         self.widgets['groupLoadSave'][1].setEnabled(state)       
         self.widgets['groupLoadSave'][2].setEnabled(state)       
 
+    def getCompositeSettings(self):
+        enabled = tuple( bool(b.checkState()) for b in self.widgets['groupTZC'][3:] )
+        chVal = tuple( tuple(lims) for lims in self.chVal )
+        return (enabled, chVal)
+
     def updateCanvas2D(self):
         (t, z, c) = self.getTZC()
         # print('Current TZC: ',t,z)
-        self.widgets['groupCanvas2D'][2].reshowImg(self.stacks[t,z], self.widgets['groupTZC'][3:], self.chVal)
-        self.widgets['groupCanvas2D'][2].updateScatter(t, z, self.points.meta)
+        settings = self.getCompositeSettings()
+        rgba_img = self.planeCache.get((t, z, settings))
+        if rgba_img is None:
+            rgba_img = self.widgets['groupCanvas2D'][2].composite(self.stacks[t,z], settings)
+            self.planeCache.put((t, z, settings), rgba_img)
+        self.widgets['groupCanvas2D'][2].reshowImg(rgba_img)
+        self.widgets['groupCanvas2D'][2].updateScatter(t, z, self.points)
+        self.prefetcher.request(self.stacks, t, z, settings)
 
     def updateCanvas3D(self):
         if not self.widgets['groupCanvas3D'][1].checkState():
             return
         (t, z, c) = self.getTZC()
-        meta = {key:[] for key in self.points.meta}
 
         # only show the current contraction phase
         if self.widgets['groupCanvas3D'][2].checkState():
-            for i, _id in enumerate( self.points.meta['_ids'] ):
-                if self.points.meta['is_instance'][i] == 1:
-                    meta['_ids'].append(_id)
-                    meta['coords'].append( self.points.meta['coords'][i][self.points.meta['coords'][i][:,3]==t] )
-                    meta['is_instance'].append(1)
-                    meta['markers'].append( self.points.meta['markers'][i] )
-                    meta['ms'].append( self.points.meta['ms'][i] )
-                    meta['colors'].append( self.points.meta['colors'][i] )
+            view = obj.PointsView(self.points, phase=t)
         else:
-            meta = copy.deepcopy( self.points.meta )
+            view = obj.PointsView(self.points)
 
         # update all lines
-        self.widgets['groupCanvas3D'][0].plot(meta,self.stacks.shape[0])
+        self.widgets['groupCanvas3D'][0].requestPlot(view,self.stacks.shape[0])
 
     def updateCcontrolled(self):
         (t, z, c) = self.getTZC()
@@ -367,27 +419,61 @@ class MyGUI(QDialog):
             obj_id = self.widgets['groupObjects'][0].currentText()
             (t, z, c) = self.getTZC()
             click_coord = np.array([np.rint(event.xdata),np.rint(event.ydata),z,t])
-            self.points.updatePoints(self.widgets['groupObjects'][0].currentText(),click_coord,event)
-            self.widgets['groupCanvas2D'][2].updateScatter(t, z, self.points.meta)
+            edit = self.points.updatePoints(self.widgets['groupObjects'][0].currentText(),click_coord,event)
+            self.widgets['groupCanvas2D'][2].updateScatter(t, z, self.points)
             self.updateCanvas3D()
-            self.widgets['groupCanvas3D'][3].populateTable(meta=self.points.meta, n_ph=self.stacks.shape[0])
+            self.widgets['groupCanvas3D'][3].updateCounts(edit)
+            self.autosave.record(edit)
+            self.history.push(edit)
         self.widgets['groupCanvas2D'][2].press = False
         self.widgets['groupCanvas2D'][2].move = False
 
     def managePoints(self):
-        input_objects = copy.deepcopy(self.points.meta)
-        w = sw.ObjectEditor(objects = input_objects)
+        # the editor only changes the objects metadata: coordinates are passed by reference
+        w = sw.ObjectEditor(objects = self.points.meta)
         if w.exec_() == QDialog.Accepted:
-            # save new objects and remember previous selection
-            self.points.meta = w.outobjects
-            obj_id = self.widgets['groupObjects'][0].currentText()
-            # repopulate list of objects combobox
-            self.widgets['groupObjects'][0].clear()
-            self.widgets['groupObjects'][0].addItems(self.points.meta['_ids'])
-            # restore previous selection if possible
-            if obj_id in self.points.meta['_ids']:
-                idx = self.points.meta['_ids'].index(obj_id)
-                self.widgets['groupObjects'][0].setCurrentIndex(idx)
+            # save new objects (unchanged objects keep their points)
+            before = self.points.state()
+            self.points.updateObjects(w.outobjects, w.origins)
+            self.history.push( ('objects', before, self.points.state()) )
+            self.autosave.reset(self.points.meta)
+            self.refreshObjects()
+
+    def refreshObjects(self):
+        # remember previous selection
+        obj_id = self.widgets['groupObjects'][0].currentText()
+        # repopulate list of objects combobox
+        self.widgets['groupObjects'][0].clear()
+        self.widgets['groupObjects'][0].addItems(self.points.meta['_ids'])
+        # restore previous selection if possible
+        if obj_id in self.points.meta['_ids']:
+            idx = self.points.meta['_ids'].index(obj_id)
+            self.widgets['groupObjects'][0].setCurrentIndex(idx)
+        (t, z, c) = self.getTZC()
+        self.widgets['groupCanvas2D'][2].updateScatter(t, z, self.points)
+        self.updateCanvas3D()
+        self.widgets['groupCanvas3D'][3].populateTable(meta=self.points.meta, n_ph=self.stacks.shape[0])
+
+    def undo(self):
+        self.showDelta( self.history.undo(self.points) )
+
+    def redo(self):
+        self.showDelta( self.history.redo(self.points) )
+
+    def showDelta(self, delta):
+        # update the views after an undo/redo
+        if delta is None:
+            return
+        if delta[0] == 'objects':
+            self.refreshObjects()
+            self.autosave.reset(self.points.meta)
+        else:
+            (t, z, c) = self.getTZC()
+            self.widgets['groupCanvas2D'][2].updateScatter(t, z, self.points)
+            self.updateCanvas3D()
+            self.widgets['groupCanvas3D'][3].updateCounts(delta)
+            self.autosave.record(delta)
+
 # if __name__ == '__main__':
 
 import sys
@@ -1,17 +1,14 @@
-from tifffile import imread
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
-from PyQt5.QtWidgets import (QWidget, QDialog, QSizePolicy, QApplication, QTableWidget, QVBoxLayout,
-                            QPushButton, QColorDialog, QTableWidgetItem, QMessageBox, QAbstractScrollArea)
+from mpl_toolkits.mplot3d import Axes3D # registers the 3d projection
+from PyQt5.QtWidgets import QWidget, QSizePolicy, QVBoxLayout, QTableView
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 from PyQt5.QtGui import QCursor, QColor
-from PyQt5.QtCore import Qt
-from matplotlib.colors import LinearSegmentedColormap
-import copy, re, time
-import matplotlib as mpl
-from ast import literal_eval
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QTimer
+import time
+import compositing as cp
 
 '''
 # classes
@@ -46,11 +43,16 @@ class Canvas2D(QWidget):
 #        self.initialize(data=data)
         self.figure.mpl_connect('button_press_event', self.onpress)
         self.figure.mpl_connect('motion_notify_event', self.hover)
-        self.cmaps = [ LinearSegmentedColormap.from_list('mycmap1', ['black', 'aqua'],N=2**16-1),
-                        LinearSegmentedColormap.from_list('mycmap2', ['black', 'red'],N=2**16-1) ]
-        self.figure.cursor = mpl.widgets.Cursor(self.axes,useblit=True,lw=1, alpha=.5)
+        self.compositor = cp.Compositor(colors=('aqua','red'))
         self.figure.setCursor(QCursor(Qt.CrossCursor))
 
+        # annotations and cursor are animated: they are blitted on top of the cached image background
+        self.background = None
+        self.points_scatter = {}
+        self.cursor = [ self.axes.axhline(lw=1, alpha=.5, animated=True, visible=False),
+                        self.axes.axvline(lw=1, alpha=.5, animated=True, visible=False) ]
+        self.figure.mpl_connect('draw_event', self.onDraw)
+
     def onpress(self,event):
         self.start = time.time()
         self.press = True
@@ -59,55 +61,76 @@ class Canvas2D(QWidget):
         self.figure.setCursor(QCursor(Qt.CrossCursor))
         if self.press:
             self.move = True
+        visible = (event.inaxes == self.axes)
+        if visible:
+            self.cursor[0].set_ydata([event.ydata,event.ydata])
+            self.cursor[1].set_xdata([event.xdata,event.xdata])
+        if visible or self.cursor[0].get_visible():
+            [ l.set_visible(visible) for l in self.cursor ]
+            self.blit()
+
+    def onDraw(self, event):
+        # a full redraw happened (new plane, contrast, resize, zoom...): cache the new background
+        self.background = self.figure.copy_from_bbox(self.figure.figure.bbox)
+        self.drawAnimated()
+
+    def drawAnimated(self):
+        for l in list(self.points_scatter.values()) + self.cursor:
+            self.axes.draw_artist(l)
+
+    def blit(self):
+        if self.background is None:
+            self.figure.draw()
+        else:
+            self.figure.restore_region(self.background)
+            self.drawAnimated()
+            self.figure.blit(self.figure.figure.bbox)
+        self.figure.flush_events()
  
     def initialize(self,data):
 #        if data == []:
 #            data = np.zeros((2,512,1024))
-        cmap1 = LinearSegmentedColormap.from_list('mycmap', ['black', 'aqua'])
-        rgba_img = cmap1(data[0])[:,:,:3]
-        cmap2 = LinearSegmentedColormap.from_list('mycmap', ['black', 'red'])
-        rgba_img += cmap2(data[1])[:,:,:3]
+        rgba_img = self.composite(data, ((True,)*data.shape[0], ((0,2**16-1),)*data.shape[0]))
 
         self.images_shown = self.axes.imshow(rgba_img)
 
-        self.points_scatter = [self.axes.plot([],[])[0]]
-
         self.axes.grid(False)
         self.axes.set_xticks([])
         self.axes.set_yticks([])
         self.axes.set_axis_off() 
         self.figure.draw()
 
-    def reshowImg(self, stacks, chButton, chVal):
-        # print('Current TZC: ',t,z)
-        rgba_img = np.zeros((*stacks.shape[1:],3))
-        for i, b in enumerate( chButton ):
-            if b.checkState():
-                lims = chVal[i]
-                channel = np.clip(stacks[i,...],lims[0],lims[1])
-                channel = (channel-np.min(channel))/(np.max(channel)-np.min(channel))
-                rgba_img += self.cmaps[i](channel)[:,:,:3]
+    def composite(self, stacks, settings):
+        # RGBA uint8 image of the channels of one plane: settings = (enabled channels, contrast limits)
+        return self.compositor.composite(stacks, settings)
+
+    def reshowImg(self, rgba_img):
         self.images_shown.set_data(rgba_img)
 
         self.figure.draw()
         self.figure.flush_events()
 
-    def updateScatter(self, t, z, meta):
-        [l.remove() for l in self.points_scatter]
-        self.points_scatter = []
-        for i, ps in enumerate( meta['coords'] ):
-            if meta['is_instance'][i] == 1:
-                ps_plot = ps[ (ps[:,2].astype(np.uint16)==z), : ]
-                ps_plot = ps_plot[ (ps_plot[:,3].astype(np.uint16)==t) ,: ]
-                self.points_scatter.append( self.axes.plot(ps_plot[:,0],ps_plot[:,1],meta['markers'][i],
-                    color=meta['colors'][i],ms=meta['ms'][i])[0] )
+    def updateScatter(self, t, z, points):
+        # one persistent artist per object (and style): only its data on the current plane is updated
+        meta = points.info
+        points_scatter = {}
+        for i in range(len(meta['_ids'])):
+            key = (i, meta['markers'][i], meta['colors'][i], meta['ms'][i])
+            if key in self.points_scatter:
+                l = self.points_scatter.pop(key)
+            else:
+                l = self.axes.plot([],[],meta['markers'][i],color=meta['colors'][i],ms=meta['ms'][i],animated=True)[0]
+            ps_plot = points.planeCoords(i, t, z)
+            l.set_data(ps_plot[:,0],ps_plot[:,1])
+            points_scatter[key] = l
+        [l.remove() for l in self.points_scatter.values()]
+        self.points_scatter = points_scatter
 
-        self.figure.draw()
-        self.figure.flush_events()
+        self.blit()
 
 class Canvas3D(FigureCanvas):
  
-    def __init__(self, parent=None, width=5, height=4, dpi=100,data=[]):
+    def __init__(self, parent=None, width=5, height=4, dpi=100,data=[], max_points=5000, delay=150):
         plt.style.use('dark_background')
         fig = Figure(figsize=(width, height), dpi=dpi)
  
@@ -131,26 +154,124 @@ class Canvas3D(FigureCanvas):
         policy.setHeightForWidth(True)
         self.setSizePolicy(policy)
         FigureCanvas.updateGeometry(self)
+
+        # one artist per object and phase, updated in place with at most max_points points in total
+        self.lines = {}
+        self.max_points = max_points
+        self.pending = None
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.plotPending)
     
     def heightForWidth(self, width):
         return width 
 
-    def plot(self,meta,n_ph):
-        self.axes.clear()
-        self.axes.grid(False)
-        # mpl.rcParams['lines.linewidth'] = 0
-        for ph in range(n_ph):
+    def requestPlot(self, view, n_ph):
+        # coalesce the updates requested in a row (e.g. while clicking) into a single plot
+        self.pending = (view, n_ph)
+        self.timer.start()
+
+    def plotPending(self):
+        if self.pending is not None:
+            (view, n_ph) = self.pending
+            self.pending = None
+            self.plot(view, n_ph)
+
+    def plot(self,view,n_ph):
+        # view: objects.PointsView, only the (object, phase) whose points changed are updated
+        meta = view.info
+        counts = {}
+        for ph in view.phases(n_ph):
             for i, obj_id in enumerate( meta['_ids'] ):
                 if meta['is_instance'][i] == 1:
-                    p = meta['coords'][i]
-                    p = p[p[:,3]==ph]
-                    self.axes.plot(p[:,0],p[:,1],p[:,2], meta['markers'][i],
-                        ms=meta['ms'][i],color=meta['colors'][i])
+                    counts[(i, ph, meta['markers'][i], meta['colors'][i], meta['ms'][i])] = view.count(i, ph)
+
+        # decimate uniformly to stay within the display budget
+        n_points = sum( counts.values() )
+        step = int(np.ceil(n_points/self.max_points)) if n_points > self.max_points else 1
+
+        lines = {}
+        for key in counts:
+            (i, ph, marker, color, ms) = key
+            if key in self.lines:
+                (l, version, bounds) = self.lines.pop(key)
+            else:
+                (l, version, bounds) = (self.axes.plot([],[],[], marker, ms=ms, color=color)[0], None, None)
+            if version != (view.version(i, ph), step):
+                version = (view.version(i, ph), step)
+                p = view.phaseCoords(i, ph)[::step]
+                l.set_data_3d(p[:,0],p[:,1],p[:,2])
+                bounds = (np.min(p[:,:3],axis=0), np.max(p[:,:3],axis=0)) if p.shape[0] > 0 else None
+            lines[key] = (l, version, bounds)
+        [l[0].remove() for l in self.lines.values()]
+        self.lines = lines
+
+        bounds = [ b for (l, v, b) in lines.values() if b is not None ]
+        if len(bounds) > 0:
+            p = np.concatenate([ np.stack(b) for b in bounds ])
+            self.axes.set_xlim3d(*self.limits(p[:,0]))
+            self.axes.set_ylim3d(*self.limits(p[:,1]))
+            self.axes.set_zlim3d(*self.limits(p[:,2]))
 
         self.draw()
         self.flush_events()
 
-class Overview(QTableWidget):
+    def limits(self, x):
+        margin = max(0.05*(np.max(x)-np.min(x)), 0.5)
+        return (np.min(x)-margin, np.max(x)+margin)
+
+class OverviewModel(QAbstractTableModel):
+    '''
+    Number of points of every object (columns) in every contraction phase (rows).
+    Counts are updated from the edits, and only cells that become empty or non-empty are repainted.
+    '''
+    def __init__(self, parent = None):
+        super(OverviewModel, self).__init__(parent)
+        self.ids = []
+        self.counts = np.zeros((0,0), dtype=int)
+
+    def rowCount(self, parent = QModelIndex()):
+        return self.counts.shape[0]
+
+    def columnCount(self, parent = QModelIndex()):
+        return self.counts.shape[1]
+
+    def data(self, index, role = Qt.DisplayRole):
+        if role == Qt.BackgroundRole:
+            if self.counts[index.row(),index.column()] > 0:
+                return QColor('#b1fc99')
+            return QColor('#db5856')
+        return None
+
+    def headerData(self, section, orientation, role = Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.ids[section]
+        return str(section+1)
+
+    def reset(self, n_ph, meta):
+        self.beginResetModel()
+        self.ids = list(meta['_ids'])
+        self.counts = np.zeros((n_ph,len(self.ids)), dtype=int)
+        for j, points in enumerate( meta['coords'] ):
+            if points.shape[0]>0:
+                phases = points[:,3].astype(int)
+                self.counts[:,j] = np.bincount(phases[(phases>=0)&(phases<n_ph)], minlength=n_ph)
+        self.endResetModel()
+
+    def updateCounts(self, edit):
+        (action, j, points) = edit[:3]
+        sign = 1 if action == 'add' else -1
+        for i in points[:,3].astype(int):
+            if 0 <= i < self.counts.shape[0]:
+                was_empty = (self.counts[i,j] == 0)
+                self.counts[i,j] += sign
+                if was_empty != (self.counts[i,j] == 0):
+                    self.dataChanged.emit(self.index(i,j), self.index(i,j), [Qt.BackgroundRole])
+
+class Overview(QTableView):
     def __init__(self, parent = None, n_ph = 5, meta = {'_ids': ['newobject']*4,
                         'colors': ['#6eadd8','#ff7f0e','red','#c4c4c4'],
                         'markers': ['o','o','X','-x'],
@@ -159,35 +280,12 @@ class Overview(QTableWidget):
                         'coords': [np.array([]),np.array([[1., 1.]]),np.array([]),np.array([[1., 2.], [3., 4.]])] }):
         super(Overview, self).__init__(parent)
         self.setParent(parent)
-        self.setRowCount(n_ph)
-        self.setColumnCount(len(meta['_ids']))
-        self.setHorizontalHeaderLabels(meta['_ids'])
+        self.setModel(OverviewModel(self))
+        self.populateTable(n_ph, meta)
     
     def populateTable(self, n_ph, meta):
-        self.setRowCount(n_ph)
-        self.setColumnCount(len(meta['_ids']))
-        self.setHorizontalHeaderLabels(meta['_ids'])
-        for i in range(self.rowCount()):
-            for j in range(self.columnCount()):
-                points = meta['coords'][j]
-                self.setItem(i,j, QTableWidgetItem())
-                if points.shape[0]>0:
-                    points = points[points[:,3]==i]
-                    if points.shape[0] > 0:
-                        color = '#b1fc99'
-                        self.item(i,j).setBackground(QColor(color))
-                    else:
-                        color = '#db5856'
-                        self.item(i,j).setBackground(QColor(color))
-                else:
-                    color = '#db5856'
-                    self.item(i,j).setBackground(QColor(color))
-
-
-
-
-
-
-
-
+        self.model().reset(n_ph, meta)
 
+    def updateCounts(self, edit):
+        if edit is not None:
+            self.model().updateCounts(edit)
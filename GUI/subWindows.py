@@ -1,16 +1,9 @@
-from tifffile import imread
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
-from PyQt5.QtWidgets import (QDialog, QSizePolicy, QApplication, QTableWidget, QVBoxLayout,
+from PyQt5.QtWidgets import (QDialog, QApplication, QTableWidget, QVBoxLayout,
                             QPushButton, QColorDialog, QTableWidgetItem, QMessageBox,
-                            QMainWindow, QLineEdit, QLabel)
-from PyQt5.QtGui import QCursor, QColor
+                            QLineEdit, QLabel)
+from PyQt5.QtGui import QColor
 from PyQt5.QtCore import Qt
-from matplotlib.colors import LinearSegmentedColormap
-import copy, re
-from ast import literal_eval
 
 '''
 # subwindow to define points
@@ -31,7 +24,7 @@ class ObjectEditor(QDialog):
         table = QTableWidget()
         table.setRowCount(len(objects['_ids']))
         table.setColumnCount(6)
-        table.setHorizontalHeaderLabels(['Object name', 'Color', 'Marker', 'Marker size', 'are instances', 'coords'])
+        table.setHorizontalHeaderLabels(['Object name', 'Color', 'Marker', 'Marker size', 'are instances', 'points'])
         self.table = table
 
         addObj = QPushButton('Add object.')
@@ -68,15 +61,17 @@ class ObjectEditor(QDialog):
         self.table.setFixedWidth(width)
 
     def populateTable(self, objects):
-        (_ids,colors,markers,ms,n,coords) = ( val for key, val in objects.items() )
+        (_ids,colors,markers,ms,n) = ( objects[key] for key in ['_ids','colors','markers','ms','is_instance'] )
+        # coordinates are not shown (nor copied): rows keep the index of their object in objects['coords']
+        self.coords = objects['coords']
         self.table.setRowCount(len(_ids))
         for i in range(len(_ids)):
-            self.table.setItem(i,0, QTableWidgetItem(_ids[i]))
+            self.table.setItem(i,0, QTableWidgetItem(_ids[i])); self.table.item(i,0).setData(Qt.UserRole, i)
             self.table.setItem(i,1, QTableWidgetItem()); self.table.item(i,1).setBackground(QColor(colors[i]))
             self.table.setItem(i,2, QTableWidgetItem(markers[i]))
             self.table.setItem(i,3, QTableWidgetItem(str(ms[i])))
             self.table.setItem(i,4, QTableWidgetItem(str(n[i])))
-            self.table.setItem(i,5, QTableWidgetItem("%s"%(coords[i])))
+            self.table.setItem(i,5, self.pointsItem(self.coords[i]))
             
         for j in range(self.table.rowCount()):
             self.table.setItem(j,4, QTableWidgetItem(str(n[j])))
@@ -86,6 +81,14 @@ class ObjectEditor(QDialog):
             flags &= ~Qt.ItemIsEnabled
             self.table.item(j, 4).setFlags(flags)
 
+    def pointsItem(self, coords):
+        # number of points, with the first ones as tooltip
+        item = QTableWidgetItem('%d points'%len(coords))
+        if len(coords) > 0:
+            item.setToolTip('\n'.join( str(c) for c in coords[:5] ) + ('\n...' if len(coords) > 5 else ''))
+        item.setFlags(item.flags() & ~Qt.ItemIsEditable)
+        return item
+
     def doubleClickEvent(self, click):
         if click.column() == 1:
             color = QColorDialog.getColor()
@@ -101,7 +104,7 @@ class ObjectEditor(QDialog):
         self.table.setItem(i,2, QTableWidgetItem(self.table.item(i-1,2).text()))
         self.table.setItem(i,3, QTableWidgetItem(str(self.table.item(i-1,3).text())))
         self.table.setItem(i,4, QTableWidgetItem(str(0)))
-        self.table.setItem(i,5, QTableWidgetItem("%s"%(np.array([]))))        
+        self.table.setItem(i,5, self.pointsItem(np.array([])))
 
     def removeRow(self):
         if self.table.rowCount()>0:
@@ -129,10 +132,9 @@ class ObjectEditor(QDialog):
         outobjects['markers'] = [self.table.item(i,2).text() for i in range(self.table.rowCount())]
         outobjects['ms'] = [self.table.item(i,3).text() for i in range(self.table.rowCount())]
         outobjects['is_instance'] = [int(self.table.item(i,4).text()) for i in range(self.table.rowCount())]
-        outobjects['coords'] = []
-        for i in range(self.table.rowCount()):
-            val = self.table.item(i,5).text()
-            outobjects['coords'].append(np.array(literal_eval(re.sub(' +', ' ',val).replace(' ',','))))
+        # index of the input object every row comes from (None for new objects)
+        self.origins = [self.table.item(i,0).data(Qt.UserRole) for i in range(self.table.rowCount())]
+        outobjects['coords'] = [ np.array([]) if o is None else self.coords[o] for o in self.origins ]
         self.outobjects = outobjects
         super().accept()
 
@@ -1,65 +1,82 @@
-from tifffile import imread
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
-from PyQt5.QtWidgets import (QDialog, QSizePolicy, QApplication, QTableWidget, QVBoxLayout,
-                            QPushButton, QColorDialog, QTableWidgetItem, QMessageBox)
-from PyQt5.QtGui import QCursor, QColor
-from PyQt5.QtCore import Qt
-from matplotlib.colors import LinearSegmentedColormap
-import copy, re, sys
-from ast import literal_eval
-import subWindows as sw
+import sys, os, json
+import lazyStacks as ls
 
 def loadStacks5D(file_name, app=False):
     print('#'*40)
     print('Loading dataset at:\n\t', file_name)
-    stacks = imread(file_name)
+    stacks = ls.LazyStack(ls.openPlanes(file_name))
     target_id = 'TZCHW'
 
-    # append dimensions if necessary
-    if not app:
-        app = QApplication(sys.argv)
-    ddef = sw.DimensionDefiner(shape=stacks.shape)
-    ddef.show()
-    if ddef.exec_() == QDialog.Accepted:
-        input_id = ddef.text
-        # find the missing id
-        missing_id = copy.deepcopy(target_id)
-        for i in input_id:
-            missing_id = missing_id.replace(i,'')
-        # append dimension
-        for i in range(len(target_id)-len(input_id)):
-            stacks = np.expand_dims(stacks,-1)
-            input_id = input_id+missing_id[i]
+    # dimension ids confirmed the last time this file was opened
+    shape = stacks.shape
+    sidecar = readSidecar(file_name, shape)
+    if sidecar is not None:
+        input_id = sidecar['dims']
     else:
-        return
+        # Qt is only needed to ask for the dimension ids
+        from PyQt5.QtWidgets import QDialog, QApplication
+        import subWindows as sw
+        if not app:
+            app = QApplication(sys.argv)
+        ddef = sw.DimensionDefiner(shape=shape)
+        ddef.show()
+        if ddef.exec_() == QDialog.Accepted:
+            input_id = ddef.text
+        else:
+            return
 
-    # reorder dimensions to match 'TZCHW'
-    if input_id != target_id:
-        for i in target_id:
-            f = input_id.index(i)
-            t = target_id.index(i)
-            stacks = np.moveaxis(stacks,f,t)
-            input_id = input_id.replace(i,'')
-            input_id = input_id[:t]+i+input_id[t:]
+    # append missing dimensions and reorder them to match 'TZCHW'
+    stacks = ls.adaptAxes(stacks, input_id, target_id)
             
-    # adjust channel dimension to 2
+    # adjust channel dimension to 2 with a virtual empty channel
     if stacks.shape[2]==1:
-      stacks = np.concatenate([stacks,np.zeros(stacks.shape)],axis=2)
+      stacks = stacks.pad(2,1)
 
-    # compute maximum values
-    _maxval = np.zeros((stacks.shape[0],stacks.shape[2]))
-    for i in range(stacks.shape[0]):
-        for j in range(stacks.shape[2]):
-            _maxval[i,j] = np.max(stacks[i,:,j,:,:])
+    if sidecar is not None:
+        _maxval = np.array(sidecar['maxval'], dtype=stacks.dtype)
+    else:
+        _maxval = computeMaxval(stacks)
+        writeSidecar(file_name, shape, input_id, _maxval)
     print('Stack shape (TZCHW):', stacks.shape)
     print('Done')
     return stacks, _maxval
 
+def sidecarName(file_name):
+    return os.path.splitext(file_name)[0]+'_dims.json'
+
+def readSidecar(file_name, shape):
+    # the sidecar is only valid if the image file has not changed since it was written
+    try:
+        with open(sidecarName(file_name)) as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        return None
+    stat = os.stat(file_name)
+    if (tuple(sidecar.get('shape',())) != tuple(shape)) or (sidecar.get('size') != stat.st_size) or (sidecar.get('mtime') != stat.st_mtime):
+        return None
+    return sidecar
+
+def writeSidecar(file_name, shape, input_id, _maxval):
+    stat = os.stat(file_name)
+    sidecar = { 'shape': list(shape), 'size': stat.st_size, 'mtime': stat.st_mtime,
+                'dims': input_id, 'maxval': _maxval.tolist() }
+    try:
+        with open(sidecarName(file_name),'w') as f:
+            json.dump(sidecar, f)
+    except OSError:
+        print('Warning: can\'t write dimension ids next to', file_name)
+
+def computeMaxval(stacks):
+    # maximum value of every (T,C) volume, reading every (t,z) plane only once
+    _maxval = np.zeros((stacks.shape[0],stacks.shape[2]), dtype=stacks.dtype)
+    for i in range(stacks.shape[0]):
+        for j in range(stacks.shape[1]):
+            np.maximum(_maxval[i], np.max(stacks[i,j],axis=(1,2)), out=_maxval[i])
+    return _maxval
+
 def swapAxes(stacks, _maxval, ax = 0):
-    stacks = np.flip( stacks, axis = ax )
+    stacks = stacks.flip( ax )
     _maxval = np.flip(_maxval,axis = ax-2)
     return stacks, _maxval
 
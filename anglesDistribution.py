@@ -7,32 +7,23 @@ Created on Tue Dec 18 10:57:49 2018
 """
 
 import numpy as np
-import glob
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
+import glob, os, time, argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import coords_io as cio
+import geometry as geo
 
 
 #%%
-def unit_vector(vector):
-    """ Returns the unit vector of the vector.  """
-    return vector / np.linalg.norm(vector)
-
-def angle_between(v1, v2):
-    """ Returns the angle in radians between vectors 'v1' and 'v2'::
-
-            >>> angle_between((1, 0), (0, 1))
-            1.5707963267948966
-            >>> angle_between((1, 0), (1, 0))
-            0.0
-            >>> angle_between((1, 0), (-1, 0))
-            3.141592653589793
-    """
-    dot = np.dot(v1,v2)
-    det = v1[0]*v2[1]-v1[1]*v2[0]
-    return np.arctan2(det,dot)
-
-def vector(p1,p2):
-    return p2-p1
+def chamber_files(fList):
+    """ Index in fList of the first Atrium, Ventricle and AVCanal files, i.e. whose name ends
+    with _<chamber>.txt (midline_*.txt files are midlines, not chambers). """
+    chidx = {}
+    names = [ os.path.basename(f) for f in fList ]
+    for chn in ['Atrium','Ventricle','AVCanal']:
+        matches = [ i for i, name in enumerate(names) if name.endswith('_'+chn+'.txt') and not name.startswith('midline') ]
+        if len(matches) > 0:
+            chidx[chn] = matches[0]
+    return chidx
 
 #%%
 
@@ -48,12 +39,7 @@ class tethers(object):
     #%% Load data
         
     def get_ch_idx(self):
-        chidx = {}
-        for chn in ['Atrium','Ventricle','AVCanal']:
-            try:
-                chidx[chn] = ['_'+chn+'.txt' in f for f in self.fList].index(True)
-            except:
-                continue
+        chidx = chamber_files(self.fList)
         assert 'AVCanal' in chidx.keys(), 'No AVCanal file! Can\'t continue analysis!'
         print('#'*40)
         print('I found the following files:')
@@ -67,13 +53,7 @@ class tethers(object):
         points = {}
         for chn in self.chamber_idx.keys():
             i = self.chamber_idx[chn]
-            tmp = []
-            with open(self.fList[i]) as f:
-                lines = f.readlines()
-                for l in lines:
-                    v=np.array(l.split(",")).astype(np.float32)
-                    tmp.append(v)
-            tmp = np.array(tmp)
+            tmp = cio.read_coords(self.fList[i], np.float32)
             points[chn] = tmp
         
         return points
@@ -85,19 +65,12 @@ class tethers(object):
         refs = self.xyz_pos['AVCanal']
         for chn in [x for x in self.chamber_idx.keys() if x != 'AVCanal']:
             tethers = self.xyz_pos[chn]
-            data = []
-            if chn == 'Ventricle':
-                vref = vector(refs[2,:2],refs[1,:2])
-            elif chn == 'Atrium':
-                vref = vector(refs[0,:2],refs[1,:2])
-            for t in tethers:
-                if chn == 'Ventricle':
-                    vtet = vector(refs[2,:2],t[:2])
-                elif chn == 'Atrium':
-                    vtet = vector(refs[0,:2],t[:2])
-                theta = angle_between(vref,vtet)*180/np.pi
-                data.append([t[2],theta])
-            zt_pos[chn] = np.array(data)
+            # angles of all the tethers around the Atrium or Ventricle end of the AVCanal
+            origin = refs[2,:2] if chn == 'Ventricle' else refs[0,:2]
+            vref = geo.vector(origin,refs[1,:2])
+            vtet = geo.vector(origin,tethers[:,:2])
+            theta = geo.angle_between(vref,vtet)*180/np.pi
+            zt_pos[chn] = np.stack([tethers[:,2],theta], axis=1)
         return zt_pos
     
     
@@ -106,6 +79,7 @@ class tethers(object):
     def plot_XY(self, chambers=['Atrium','Ventricle'],
                 xlim=(0,1000), ylim=(0,1000),
                 alpha=0.5, ms=6, marker='o'):
+        import matplotlib.pyplot as plt
         if isinstance(chambers,str): chambers = [chambers]
         chamber_names = list(self.chamber_idx.keys())
         assert all([ch in chamber_names for ch in chambers]), 'Can\'t recognize the chamber!'
@@ -136,6 +110,8 @@ class tethers(object):
     def plot_XYZ(self, chambers=['Atrium','Ventricle'],
                 xlim=(0,1000), ylim=(0,1000),
                 alpha=0.5, ms=6):
+        import matplotlib.pyplot as plt
+        from mpl_toolkits.mplot3d import Axes3D # registers the 3d projection
         fig = plt.figure(figsize=(5,5))
         plt.subplots_adjust(left=0.05,bottom=0.05,right=0.95,top=0.95)
         ax = fig.add_subplot(111, projection='3d')
@@ -168,6 +144,7 @@ class tethers(object):
 
     def plot_ZT_singleChamber(self, chamber,
                               marker='|'):
+        import matplotlib.pyplot as plt
         chamber_names = list(self.chamber_idx.keys())
         assert chamber in chamber_names, 'Can\'t recognize the chamber!'
         assert chamber != 'AVCanal', 'AVCanal is not a chamber!'
@@ -196,31 +173,72 @@ class tethers(object):
         for chn in [x for x in self.chamber_idx.keys() if x != 'AVCanal']:
             np.savetxt(outfile+'angles'+chn+'.txt',self.zt_pos[chn])
 
-'''
-The only input needed
-'''
-paths = [ '180907_kdrlrasCherry_myl7radGFP_001_merged',
-    '180907_kdrlrasCherry_myl7radGFP_002_merged',
-    '180914_kdrlrasCherry_mylGFP_ZO1_3_merge',
-    '180914_kdrlrasCherry_mylGFP_ZO1_4_merge_good',
-    '180928_kdrlrasCherry_myl7rasGFP_paxillin_2_merge_good',
-    '180928_kdrlrasCherry_myl7rasGFP_paxillin_3_merge_good',
-    '180928_kdrlrasCherry_myl7rasGFP_paxillin_4_merge_good',
-    '181107_kdrlRasCherry_Myl7GFP_phalloidine647_003_merge/try1',
-    '181107_kdrlRasCherry_Myl7GFP_phalloidine647_003_merge/try2',
-    '181107_kdrlRasCherry_Myl7GFP_phalloidine647_001_merge/try1',
-    '181107_kdrlRasCherry_Myl7GFP_phalloidine647_001_merge/try2_better',
-    ]
-
-path = paths[3]
-### load data
-data = tethers(path)
-
-### plot and save data
-data.plot_XY(chambers=['Atrium','Ventricle'])
-data.plot_ZT(chambers='Atrium')
-# data.plot_ZT(chambers='Ventricle')
-data.plot_XYZ()
-# data.save_angles_data()
-#
-plt.show()
\ No newline at end of file
+#%% batch processing
+
+def find_datasets(roots):
+    """ Directories (below any of roots) containing an AVCanal file and an Atrium or Ventricle file
+    (as found by tethers.get_ch_idx), i.e. a dataset to analyse. """
+    if isinstance(roots,str): roots = [roots]
+    dirs = set()
+    for root in roots:
+        for f in glob.glob(os.path.join(root,'**','*_AVCanal.txt'), recursive=True):
+            dirs.add(os.path.dirname(f))
+    paths = []
+    for path in sorted(dirs):
+        chidx = chamber_files(sorted(glob.glob(path+'/*.txt')))
+        if ('AVCanal' in chidx) and (('Atrium' in chidx) or ('Ventricle' in chidx)):
+            paths.append(path)
+    return paths
+
+def process_dataset(path, save=False):
+    """ Loads a dataset, extracts its angles and saves them. Returns (path, number of tethers per chamber, seconds). """
+    start = time.time()
+    data = tethers(path)
+    if save:
+        data.save_angles_data()
+    n_tethers = { chn: data.zt_pos[chn].shape[0] for chn in data.zt_pos }
+    return path, n_tethers, time.time()-start
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extract (and optionally save) the angles of the tethers of every dataset directory containing an AVCanal file.')
+    parser.add_argument('roots', nargs='+', help='directories searched (recursively) for datasets')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of processes (default: number of cpus)')
+    parser.add_argument('--save', action='store_true', help='save the angles files (_angles<chamber>.txt) in every dataset, overwriting existing ones')
+    parser.add_argument('--plot', action='store_true', help='plot every dataset (XY, ZT of the Atrium and XYZ) instead')
+    args = parser.parse_args(argv)
+
+    paths = find_datasets(args.roots)
+    print('Found %d datasets'%len(paths))
+
+    if args.plot:
+        import matplotlib.pyplot as plt
+        for path in paths:
+            ### load data
+            data = tethers(path)
+
+            ### plot and save data
+            data.plot_XY(chambers=['Atrium','Ventricle'])
+            data.plot_ZT(chambers='Atrium')
+            data.plot_XYZ()
+            if args.save:
+                data.save_angles_data()
+        plt.show()
+        return
+
+    start = time.time()
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = { pool.submit(process_dataset, path, args.save): path for path in paths }
+        for future in as_completed(futures):
+            try:
+                path, n_tethers, elapsed = future.result()
+                print('%8.2f s  %s  %s'%(elapsed, path, ', '.join('%s: %d'%(chn,n) for chn, n in n_tethers.items())))
+            except Exception as e:
+                failed.append(futures[future])
+                print('  FAILED  %s  (%s)'%(futures[future], e))
+    print('#'*40)
+    print('%d datasets processed in %.2f s, %d failed'%(len(paths)-len(failed), time.time()-start, len(failed)))
+    return failed
+
+if __name__ == '__main__':
+    main()
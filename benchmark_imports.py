@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Import time of the analysis and GUI modules, each measured in a fresh interpreter,
+and whether importing them loads matplotlib or PyQt5.
+
+Usage: python benchmark_imports.py [n_repeats]
+"""
+
+import subprocess, sys, os
+
+root = os.path.dirname(os.path.abspath(__file__))
+
+modules = [ (root, 'midline_frames'),
+            (root, 'plot_midline_fromGUI'),
+            (root, 'plot_midline_fromFIJI'),
+            (root, 'anglesDistribution'),
+            (os.path.join(root,'GUI'), 'objects'),
+            (os.path.join(root,'GUI'), 'annotations'),
+            (os.path.join(root,'GUI'), 'autosave'),
+            (os.path.join(root,'GUI'), 'utils'),
+            (os.path.join(root,'GUI'), 'subClasses') ]
+
+probe = """
+import sys, time
+start = time.perf_counter()
+import %s
+elapsed = time.perf_counter()-start
+print(elapsed, 'matplotlib' in sys.modules, 'PyQt5' in sys.modules)
+"""
+
+def time_import(path, module, n_repeats=5):
+    """ Returns the best import time (s) of module over n_repeats interpreters, and whether
+    matplotlib and PyQt5 were loaded. """
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen', MPLBACKEND='Agg')
+    best = None
+    for i in range(n_repeats):
+        out = subprocess.run([sys.executable, '-c', probe%module], cwd=path, env=env,
+                                capture_output=True, text=True)
+        if out.returncode != 0:
+            return None, None, None
+        elapsed, mpl, qt = out.stdout.split()[-3:]
+        best = float(elapsed) if best is None else min(best, float(elapsed))
+    return best, mpl == 'True', qt == 'True'
+
+if __name__ == '__main__':
+
+    n_repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print('%-24s %10s %12s %8s'%('module','time (ms)','matplotlib','PyQt5'))
+    for path, module in modules:
+        elapsed, mpl, qt = time_import(path, module, n_repeats)
+        if elapsed is None:
+            print('%-24s %10s'%(module,'failed'))
+        else:
+            print('%-24s %10.1f %12s %8s'%(module,elapsed*1000,mpl,qt))
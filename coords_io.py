@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reader of the comma separated coordinates files saved from FIJI (_Atrium.txt, _Ventricle.txt,
+_AVCanal.txt, midline_*.txt), shared by anglesDistribution.py and plot_midline_fromFIJI.py.
+
+Every file is parsed in a single np.loadtxt call, and the values are cached in a .npy file beside
+it (file_name+'.npy'), whose mtime is set to the one of the text file: the cache is only used
+while the two mtimes match, i.e. until the text file is edited.
+"""
+
+import numpy as np
+import os, re
+
+# a line of comma separated numbers, e.g. '619.5,347,9'
+_number = r'\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*'
+_coords_line = re.compile(r'^%s(,%s)*$'%(_number,_number))
+
+def cache_name(file_name):
+    return file_name+'.npy'
+
+def parse_coords(file_name):
+    """ Returns the (n_lines, n_values) float64 array of the numbers in file_name.
+    Lines which are not only comma separated numbers (e.g. headers or empty lines) are skipped. """
+    with open(file_name) as f:
+        text = f.read()
+    lines = text.splitlines()
+    try:
+        coords = np.loadtxt(lines, delimiter=',', ndmin=2)
+    except ValueError:
+        lines = [ l for l in lines if _coords_line.match(l) ]
+        coords = np.loadtxt(lines, delimiter=',', ndmin=2) if len(lines) > 0 else np.zeros((0,3))
+    return coords
+
+def read_coords(file_name, dtype=np.float64, cache=True):
+    """ Returns the coordinates in file_name as a (n_lines, n_values) array of type dtype,
+    from its .npy cache if it is up to date, and updates the cache otherwise. """
+    stat = os.stat(file_name)
+    cache_file = cache_name(file_name)
+    if cache:
+        try:
+            if os.stat(cache_file).st_mtime_ns == stat.st_mtime_ns:
+                return np.load(cache_file).astype(dtype, copy=False)
+        except (OSError, ValueError):
+            pass
+
+    coords = parse_coords(file_name)
+
+    if cache:
+        # written to a temporary file first, as several processes may read the same dataset
+        tmp_file = '%s.%d.tmp'%(cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as f:
+                np.save(f, coords)
+            os.utime(tmp_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            # e.g. read-only dataset directory: just don't cache
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    return coords.astype(dtype, copy=False)
+
+if __name__ == '__main__':
+
+    # reading time of the previous line by line parsing, of np.loadtxt and of the .npy cache
+    import tempfile, shutil
+    from time import time
+
+    def read_lines(file_name):
+        tmp = []
+        with open(file_name) as f:
+            for l in f.readlines():
+                tmp.append(np.array(l.split(",")).astype(np.float32))
+        return np.array(tmp)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for n in [1000, 10000, 100000]:
+            file_name = os.path.join(tmp_dir, '_Atrium_%d.txt'%n)
+            coords = np.round(np.random.rand(n,3)*[1000,1000,60]*2)/2
+            np.savetxt(file_name, coords, delimiter=',', fmt='%g')
+
+            start = time(); ref = read_lines(file_name); t_lines = time()-start
+            start = time(); new = read_coords(file_name, np.float32); t_parse = time()-start
+            start = time(); cached = read_coords(file_name, np.float32); t_cache = time()-start
+            assert np.array_equal(ref, new) and np.array_equal(ref, cached)
+            print('%6d lines: line by line %7.1f ms, loadtxt %6.1f ms, cache %5.2f ms'%(n, t_lines*1e3, t_parse*1e3, t_cache*1e3))
+
+        # the cache is refreshed when the file changes
+        np.savetxt(file_name, coords[:10], delimiter=',', fmt='%g')
+        os.utime(file_name, ns=(0, os.stat(file_name).st_mtime_ns+10**9))
+        assert read_coords(file_name).shape == (10,3)
+    finally:
+        shutil.rmtree(tmp_dir)
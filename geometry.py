@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vector kernels shared by anglesDistribution.py, plot_midline_fromGUI.py and plot_midline_fromFIJI.py.
+They take single points/vectors as well as (N,2) or (N,3) arrays of them, broadcast against each other.
+"""
+
+import numpy as np
+
+def vector(p1,p2):
+    """ Returns the vectors from the points p1 to the points p2. """
+    return np.asarray(p2)-np.asarray(p1)
+
+def unit_vector(vector):
+    """ Returns the unit vectors of the vectors (along the last axis). """
+    vector = np.asarray(vector)
+    return vector / np.linalg.norm(vector, axis=-1, keepdims=True)
+
+def angle_between(v1, v2):
+    """ Returns the signed angles in radians from the vectors 'v1' to the vectors 'v2',
+    in the XY plane (counterclockwise is positive)::
+
+            >>> angle_between((1, 0), (0, 1))
+            1.5707963267948966
+            >>> angle_between((1, 0), (1, 0))
+            0.0
+            >>> angle_between((1, 0), (-1, 0))
+            3.141592653589793
+            >>> angle_between((1, 0), [(0, 1), (0, -1), (-1, 0)])
+            array([ 1.57079633, -1.57079633,  3.14159265])
+    """
+    v1 = np.asarray(v1)
+    v2 = np.asarray(v2)
+    dot = np.sum(v1*v2, axis=-1)
+    det = v1[...,0]*v2[...,1]-v1[...,1]*v2[...,0]
+    angle = np.arctan2(det,dot)
+    return angle if np.ndim(angle) > 0 else float(angle)
+
+if __name__ == '__main__':
+
+    # doctests, and angles of the test dataset against the stored ones and the previous per-tether loop
+    import doctest, os
+    from time import time
+    import anglesDistribution as ad
+
+    doctest.testmod()
+
+    def extract_angles_loop(refs, tethers, chn):
+        origin = refs[2,:2] if chn == 'Ventricle' else refs[0,:2]
+        vref = vector(origin,refs[1,:2])
+        data = []
+        for t in tethers:
+            dot = np.dot(vref,t[:2]-origin)
+            det = vref[0]*(t[1]-origin[1])-vref[1]*(t[0]-origin[0])
+            data.append([t[2],np.arctan2(det,dot)*180/np.pi])
+        return np.array(data)
+
+    basedir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'test_unwrap_heart')
+    data = ad.tethers(basedir)
+    refs = data.xyz_pos['AVCanal']
+    for chn in data.zt_pos:
+        ref = extract_angles_loop(refs, data.xyz_pos[chn], chn)
+        assert np.array_equal(ref, data.zt_pos[chn]), 'angles differ from the loop version'
+        stored = np.loadtxt(os.path.join(basedir,'_angles'+chn+'.txt'))
+        if stored.shape == ref.shape:
+            err = np.max(np.abs(stored-data.zt_pos[chn]))
+            print('%s: %d angles, max abs difference to the stored ones %.1e deg'%(chn, ref.shape[0], err))
+            assert err < 1e-3
+        else:
+            print('%s: %d angles, stored file is from another dataset (%d angles)'%(chn, ref.shape[0], stored.shape[0]))
+
+    for n in [1000, 10000, 100000]:
+        tethers = np.random.rand(n,3).astype(np.float32)*[1000,1000,60]
+        start = time(); ref = extract_angles_loop(refs, tethers, 'Atrium'); t_loop = time()-start
+        start = time()
+        origin = refs[0,:2]
+        new = np.stack([tethers[:,2], angle_between(vector(origin,refs[1,:2]), vector(origin,tethers[:,:2]))*180/np.pi], axis=1)
+        t_vect = time()-start
+        print('%6d tethers: loop %7.1f ms, batch %5.2f ms (max abs difference %.1e deg)'%(n, t_loop*1e3, t_vect*1e3, np.max(np.abs(ref-new))))
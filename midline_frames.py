@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tangent, normal and binormal frames along a sampled midline, computed with
+batched array operations (shared by plot_midline_fromGUI.py and plot_midline_fromFIJI.py).
+"""
+
+import numpy as np
+import hashlib
+import geometry as geo
+
+def compute_rot_mat(d,th):
+    ct = np.cos(th)
+    st = np.sin(th)
+    ct_d = 1-ct
+    r1 = np.array( [ ct+d[0]*d[0]*ct_d, d[0]*d[1]*ct_d-d[2]*st, d[0]*d[2]*ct_d+d[1]*st ] )
+    r2 = np.array( [ d[0]*d[1]*ct_d+d[2]*st, ct+d[1]*d[1]*ct_d, d[1]*d[2]*ct_d-d[0]*st ] )
+    r3 = np.array( [ d[0]*d[2]*ct_d-d[1]*st, d[1]*d[2]*ct_d+d[0]*st, ct+d[2]*d[2]*ct_d ] )
+    return np.stack([r1,r2,r3])
+
+def normalize_rows(v):
+    norm = np.linalg.norm(v, axis=1, keepdims=True)
+    return v / np.where(norm>0, norm, 1.)
+
+def compute_rot_mats(d, th):
+    """ Batched compute_rot_mat: rotations of angles th (n,) around the unit axes d (n,3). """
+    ct = np.cos(th)[:,None,None]
+    st = np.sin(th)[:,None,None]
+    cross = np.zeros((d.shape[0],3,3))
+    cross[:,0,1], cross[:,0,2], cross[:,1,2] = -d[:,2], d[:,1], -d[:,0]
+    cross -= np.transpose(cross, (0,2,1))
+    return ct*np.eye(3) + st*cross + (1-ct)*d[:,:,None]*d[:,None,:]
+
+def cumulative_matmul(mats):
+    """ Prefix products P[k] = mats[k] @ ... @ mats[0], in log2(n) batched matmul steps. """
+    P = np.array(mats, copy=True)
+    step = 1
+    while step < P.shape[0]:
+        P[step:] = np.matmul(P[step:], P[:-step])
+        step *= 2
+    return P
+
+def anchors_hash(anchors):
+    """ Hash of the anchor points of a midline, to tell whether cached frames are still valid. """
+    anchors = np.ascontiguousarray(anchors)
+    return hashlib.sha1(anchors.tobytes()+str(anchors.shape).encode()).hexdigest()
+
+def transport_normals(T, N0, eps=1e-12):
+    """ Parallel transport of the normal N0 along the unit tangents T (n,3)
+    (https://janakiev.com/blog/framing-parametric-curves/): the normal is rotated by the
+    rotations between consecutive tangents.
+    """
+    N = np.empty(T.shape)
+    N[0] = N0
+    if T.shape[0] > 1:
+        b = np.cross(T[:-1], T[1:]) # cross product of consecutive tangents
+        b_norm = np.linalg.norm(b, axis=1)
+        phi = np.arccos(np.clip(np.sum(T[:-1]*T[1:], axis=1), -1., 1.)) # angle between consecutive tangents
+        # no rotation where consecutive tangents are (numerically) parallel
+        straight = b_norm < eps
+        b = b / np.where(straight, 1., b_norm)[:,None]
+        phi[straight] = 0.
+        R = cumulative_matmul(compute_rot_mats(b, phi))
+        N[1:] = np.matmul(R, N0)
+    return N
+
+def compute_frames(S, method='pt', eps=1e-12):
+    """ Returns the tangents T, normals N and binormals B (n,3) of the midline sampled in S (n,3).
+
+    'fs': Frenet-Serret frame, N is the normalized derivative of T.
+    'pt': parallel-transported frame, the first normal is transported along the curve.
+    """
+    assert(method in ['fs','pt']), 'Invalid method!'
+
+    T = normalize_rows(np.gradient(S,edge_order=2,axis=0))
+    N = normalize_rows(np.gradient(T,edge_order=2,axis=0))
+    if method == 'pt':
+        N = transport_normals(T, N[0], eps)
+
+    B = np.cross(T, N)
+    return T, N, B
+
+class ArcLengthSpline(object):
+    """ Arc-length parametrization of a 3D spline tck (as returned by splprep).
+
+    The length of the spline is integrated by Gauss-Legendre quadrature on n_table intervals
+    of its parameter, and the table of cumulative lengths is inverted (with one Newton step)
+    to sample the curve at any arc length. Positions, tangents and normals come from the
+    derivatives of the spline, so sampling density is independent of the length of the curve.
+    """
+    def __init__(self, tck, n_table=1000, order=5):
+        self.tck = tck
+        self.k = tck[2]
+        self.nodes, self.weights = np.polynomial.legendre.leggauss(order)
+        self.u_table = np.linspace(0,1,n_table+1)
+        pieces = self.integrate_speed(self.u_table[:-1], self.u_table[1:])
+        self.s_table = np.concatenate([[0.], np.cumsum(pieces)])
+        self.length = self.s_table[-1]
+
+    def derivative(self, u, der):
+        from scipy import interpolate
+        return np.transpose( interpolate.splev(u, self.tck, der=der) ).reshape(-1,3)
+
+    def integrate_speed(self, a, b):
+        # length of the spline between the parameters a and b
+        half = (b-a)/2
+        u = (a+b)[:,None]/2 + half[:,None]*self.nodes
+        speed = np.linalg.norm(self.derivative(u.ravel(), 1), axis=1).reshape(u.shape)
+        return half*np.sum(self.weights*speed, axis=1)
+
+    def parameter(self, s):
+        """ Spline parameter u at the arc lengths s. """
+        s = np.clip(np.asarray(s, dtype=float), 0, self.length)
+        u = np.interp(s, self.s_table, self.u_table)
+        # one Newton step on the length integrated from the closest table entry
+        j = np.clip(np.searchsorted(self.u_table, u, side='right')-1, 0, len(self.u_table)-2)
+        err = self.s_table[j] + self.integrate_speed(self.u_table[j], u) - s
+        speed = np.linalg.norm(self.derivative(u, 1), axis=1)
+        return np.clip(u - err/np.where(speed>0, speed, np.inf), 0, 1)
+
+    def frames(self, s, method='pt', eps=1e-12):
+        """ Positions S, tangents T and normals N (n,3) at the arc lengths s, and their parameters u. """
+        assert(method in ['fs','pt']), 'Invalid method!'
+        u = self.parameter(s)
+        S = self.derivative(u, 0)
+        d1 = self.derivative(u, 1)
+        T = normalize_rows(d1)
+        if self.k >= 2:
+            # component of the acceleration normal to the tangent
+            d2 = self.derivative(u, 2)
+            N = normalize_rows(d2 - np.sum(d2*T, axis=1, keepdims=True)*T)
+        else:
+            N = normalize_rows(np.gradient(T,edge_order=2,axis=0))
+        if method == 'pt':
+            N = transport_normals(T, N[0], eps)
+        return S, T, N, u
+
+def midline_frames(centroid, smooth_order=100, interp_order=3, method='pt', spacing=1., cache=None, verbose=False):
+    """ Number of samples, positions S, tangents T, normals N and binormals B (n,3) of the spline
+    through the anchors centroid (m,3), sampled every `spacing` along its length (1pxl by default).
+    If a cache dictionary is given, the frames are computed once per set of anchors and parameters. """
+    assert(method in ['fs','pt']), 'Invalid method!'
+    key = (smooth_order, interp_order, method, spacing, anchors_hash(centroid))
+    if (cache is not None) and (key in cache):
+        return cache[key]
+    # # spline interpolation
+    from scipy import interpolate
+    tck, u = interpolate.splprep(np.transpose(centroid), s=smooth_order, k=interp_order)
+    # arc-length parametrization: positions, tangents and normals from the spline derivatives
+    spline = ArcLengthSpline(tck)
+    if verbose:
+        print('Spline length: %.3f'%spline.length)
+    n_points_spline = int(spline.length/spacing)
+    S, T, N, u = spline.frames(np.linspace(0, spline.length, n_points_spline), method=method)
+    B = np.cross(T, N)
+    if cache is not None:
+        cache[key] = (n_points_spline, S, T, N, B)
+    return n_points_spline, S, T, N, B
+
+def project_points(P, S, N, s=None, tck=None, u=None, n_iter=5):
+    """ Projects the points P (m,3) on the midline sampled in S (n,3) with normals N (n,3).
+
+    Extra coordinates (e.g. to keep apart the midlines of different phases) are allowed, as long as
+    the normals are 0 along them. Returns, for every point, the position s of its closest midline sample (by default normalized
+    between 0 and 1), the angle (degrees) of the vector from that sample to the point with respect to
+    the normal (as angle_between: 3D dot product, XY determinant) and the distance from the midline.
+    If the spline tck that generated S is given (with the parameters u of the samples, uniform by
+    default), the closest point is refined on the continuous spline with a few Newton steps.
+    """
+    from scipy.spatial import cKDTree
+    P = np.asarray(P, dtype=float).reshape(-1,S.shape[1])
+    if s is None:
+        s = np.linspace(0,1,S.shape[0])
+    _, i = cKDTree(S).query(P)
+    pos, C, normals = s[i], S[i], N[i]
+
+    if (tck is not None) and (P.shape[0] > 0) and (S.shape[0] > 1):
+        from scipy import interpolate
+        if u is None:
+            u = np.linspace(0,1,S.shape[0])
+        lo, hi = u[np.maximum(i-1,0)], u[np.minimum(i+1,S.shape[0]-1)]
+        t = u[i]
+        for k in range(n_iter):
+            d = np.transpose(interpolate.splev(t, tck)) - P
+            d1 = np.transpose(interpolate.splev(t, tck, der=1))
+            d2 = np.transpose(interpolate.splev(t, tck, der=2))
+            h = np.sum(d1*d1, axis=1) + np.sum(d*d2, axis=1)
+            step = np.sum(d*d1, axis=1) / np.where(h>0, h, np.inf)
+            t = np.clip(t-step, lo, hi)
+        C = np.transpose(interpolate.splev(t, tck))
+        # position and normal interpolated between the neighbouring samples
+        j = np.clip(np.searchsorted(u, t, side='right')-1, 0, S.shape[0]-2)
+        w = ((t-u[j])/(u[j+1]-u[j]))[:,None]
+        pos = s[j]*(1-w[:,0]) + s[j+1]*w[:,0]
+        normals = normalize_rows(N[j]*(1-w) + N[j+1]*w)
+
+    v = P - C
+    return pos, geo.angle_between(v, normals)*180/np.pi, np.linalg.norm(v, axis=1)
+
+def remove_duplicates(points):
+    """ Drops the points (rows) equal to the previous one, e.g. double clicks. """
+    points = np.asarray(points)
+    if points.shape[0] < 2:
+        return points
+    keep = np.ones(points.shape[0], dtype=bool)
+    keep[1:] = np.any(points[1:] != points[:-1], axis=1)
+    return points[keep]
+
+def fix_outliers(points, idx=-1, thr=2.):
+    """ Replaces, in order, every point reached by a step longer than thr times the mean (initial) step
+    with the midpoint of its neighbours. Steps are measured along column idx, or in XY if idx is -1.
+    A replacement changes the next step, which is checked again (e.g. a level shift is turned into a
+    ramp: 50, 75, 87.5, ...), so only the long steps and the ones after a replacement are visited.
+    """
+    points = np.array(points, dtype=float)
+    assert -1 <= idx < points.shape[1], 'Invalid column index (%d) for points with %d columns!'%(idx, points.shape[1])
+    if points.shape[0] < 3:
+        return points
+    def steps(a, b):
+        # lengths of the steps from the points a..b-1 to the next ones
+        if idx == -1:
+            return np.linalg.norm(np.diff(points[a:b+1,:2], axis=0), axis=1)
+        return np.abs(np.diff(points[a:b+1,idx]))
+    diff = steps(0, points.shape[0]-1)
+    limit = thr*np.mean(diff)
+    flagged = np.nonzero(diff > limit)[0]
+    i = flagged[0] if len(flagged) > 0 else None
+    # the last point has no next neighbour
+    while (i is not None) and (i < points.shape[0]-2):
+        if steps(i, i+1)[0] > limit:
+            points[i+1] = (points[i]+points[i+2])/2
+            # the step after the replaced point changed: it is checked next
+            i += 1
+        else:
+            k = np.searchsorted(flagged, i, side='right')
+            i = flagged[k] if k < len(flagged) else None
+    return points
+
+def smooth_points(points, sigma=5):
+    """ Gaussian smoothing (sigma in points) of every column of points. """
+    from scipy.ndimage import gaussian_filter1d
+    return gaussian_filter1d(np.asarray(points, dtype=float), sigma, axis=0)
+
+def preprocess_anchors(anchors, dedupe=True, unwrap_idx=None, period=180., outlier_idx=None, thr=2.,
+                       sigma=None, phases=False):
+    """ Preprocessing of midline anchors (n,d): consecutive duplicates removal, unwrapping of the angles
+    in column unwrap_idx (with the given period), outlier replacement (fix_outliers, with steps along
+    column outlier_idx) and Gaussian smoothing. Steps set to None (or False) are skipped.
+
+    If phases, the last column holds the contraction phase of every anchor, which is not modified: all the
+    phases are processed in one call, each one separately, and returned grouped by phase (in their
+    original order within each phase).
+    """
+    anchors = np.asarray(anchors)
+    if dedupe:
+        anchors = remove_duplicates(anchors)
+    if (unwrap_idx is None) and (outlier_idx is None) and (sigma is None):
+        return anchors
+
+    if phases:
+        order = np.argsort(anchors[:,-1], kind='stable')
+        out = np.array(anchors[order], dtype=float)
+        starts = np.r_[0, np.nonzero(np.diff(out[:,-1]))[0]+1, out.shape[0]]
+        segments = [ out[a:b,:-1] for a, b in zip(starts[:-1], starts[1:]) ]
+    else:
+        out = np.array(anchors, dtype=float)
+        segments = [ out ]
+    # every segment is a view of out, processed in place
+    for coords in segments:
+        if unwrap_idx is not None:
+            coords[:,unwrap_idx] = np.unwrap(coords[:,unwrap_idx], period=period)
+        if outlier_idx is not None:
+            coords[...] = fix_outliers(coords, outlier_idx, thr)
+        if sigma is not None:
+            coords[...] = smooth_points(coords, sigma)
+    return out
+
+if __name__ == '__main__':
+
+    # benchmark and tolerance check against the previous per-sample loop
+    from time import time
+
+    def compute_frames_loop(S, method='pt'):
+        T = np.gradient(S,edge_order=2,axis=0)
+        T = np.array( [ t/np.linalg.norm(t) for t in T ] )
+        N = np.gradient(T,edge_order=2,axis=0)
+        N = np.array( [ n/np.linalg.norm(n) for n in N ] )
+        if method == 'pt':
+            for i in range(S.shape[0] - 1):
+                b = np.cross(T[i], T[i + 1])
+                b = b / np.linalg.norm(b)
+                phi = np.arccos(np.dot(T[i], T[i + 1]))
+                R = compute_rot_mat(b,phi)
+                N[i + 1] = np.dot(R, N[i])
+        B = np.array([np.cross(t, n) for (t, n) in zip(T, N)])
+        return T, N, B
+
+    for n in [500, 5000, 50000]:
+        u = np.linspace(0, 4*np.pi, n)
+        S = np.transpose([ 50*np.cos(u), 30*np.sin(u), 20*u+5*np.sin(3*u) ])
+        for method in ['fs','pt']:
+            start = time(); ref = compute_frames_loop(S, method); t_loop = time()-start
+            start = time(); new = compute_frames(S, method); t_vect = time()-start
+            err = max( np.max(np.abs(a-b)) for a, b in zip(ref, new) )
+            assert err < 1e-8, 'frames differ from the loop version (%g)'%err
+            print('%6d samples, %s: loop %8.1f ms, vectorized %6.1f ms (max abs difference %.1e)'%(n, method, t_loop*1e3, t_vect*1e3, err))
+
+    # projection of tethers against the previous per-tether loop over all the samples
+    def project_points_loop(P, S, N):
+        s = np.linspace(0,1,S.shape[0])
+        out = []
+        for tether in P:
+            dist = [np.linalg.norm(tether-spline) for spline in S]
+            i = np.where(dist==np.min(dist))[0][0]
+            v1, v2 = tether-S[i], N[i]
+            out.append([s[i], np.arctan2(v1[0]*v2[1]-v1[1]*v2[0], np.dot(v1,v2))*180/np.pi])
+        return np.array(out)
+
+    rng = np.random.default_rng(0)
+    u = np.linspace(0, 4*np.pi, 1000)
+    S = np.transpose([ 50*np.cos(u), 30*np.sin(u), 20*u ])
+    T, N, B = compute_frames(S)
+    project_points(S[:10], S, N) # warm-up, so that scipy imports are not timed
+    for m in [100, 1000, 10000]:
+        P = S[rng.integers(0,S.shape[0],m)] + rng.normal(0,10,(m,3))
+        start = time(); ref = project_points_loop(P, S, N) if m <= 1000 else None; t_loop = time()-start
+        start = time(); pos, angle, radius = project_points(P, S, N); t_tree = time()-start
+        if ref is not None:
+            assert np.allclose(ref, np.transpose([pos, angle])), 'projection differs from the loop version'
+            print('%6d tethers: loop %8.1f ms, kd-tree %6.1f ms'%(m, t_loop*1e3, t_tree*1e3))
+        else:
+            print('%6d tethers: kd-tree %6.1f ms'%(m, t_tree*1e3))
+
+    # arc-length sampling against the previous two-pass uniform-parameter sampling
+    from scipy import interpolate
+    u = np.linspace(0, 4*np.pi, 40)
+    tck, _ = interpolate.splprep([ 50*np.cos(u), 30*np.sin(u), 2*u*(1+u) ], s=0)
+    fine = np.transpose(interpolate.splev(np.linspace(0,1,1000001), tck))
+    true_length = np.sum(np.linalg.norm(np.diff(fine,axis=0),axis=1))
+    start = time()
+    S = np.transpose(interpolate.splev(np.linspace(0,1,10000), tck))
+    n = int(np.sum(np.linalg.norm(np.diff(S,axis=0),axis=1)))
+    S = np.transpose(interpolate.splev(np.linspace(0,1,n), tck))
+    T, N, B = compute_frames(S)
+    t_old = time()-start
+    d_old = np.linalg.norm(np.diff(S,axis=0),axis=1)
+    start = time()
+    spline = ArcLengthSpline(tck)
+    S, T, N, u = spline.frames(np.linspace(0, spline.length, int(spline.length)))
+    t_new = time()-start
+    d_new = np.linalg.norm(np.diff(S,axis=0),axis=1)
+    print('uniform parameter: %.1f ms, sample spacing %.3f-%.3f'%(t_old*1e3, d_old.min(), d_old.max()))
+    print('arc length:        %.1f ms, sample spacing %.3f-%.3f, length error %.1e'%(t_new*1e3, d_new.min(), d_new.max(), abs(spline.length-true_length)))
+
+    # anchors preprocessing against the previous row by row loops, on dense click-traced midlines
+    def clean_up_points_loop(coords):
+        new = np.array([coords[0]])
+        for c in coords[1:]:
+            if any( c!=new[-1] ):
+                new = np.concatenate((new,[c]))
+        return new
+
+    def fix_outliers_loop(coords, idx=-1, thr=2.):
+        coords = np.array(coords)
+        for i in range(coords.shape[0]-1):
+            if np.abs(coords[i+1,2] - coords[i,2])>90:
+                coords[i+1,2] -= 180
+        if idx == -1:
+            diff = np.sqrt(np.diff(coords[:,0])**2+np.diff(coords[:,1])**2)
+        else:
+            diff = np.abs(np.diff(coords[:,idx]))
+        diff_mean = np.mean(diff)
+        for i in range(coords.shape[0]-2):
+            if diff[i]>(thr*diff_mean):
+                coords[i+1] = (coords[i]+coords[i+2])/2
+                if idx == -1:
+                    diff = np.sqrt(np.diff(coords[:,0])**2+np.diff(coords[:,1])**2)
+                else:
+                    diff = np.abs(np.diff(coords[:,idx]))
+        return coords
+
+    smooth_points(S[:10]) # warm-up
+    for n in [1000, 5000, 20000]:
+        u = np.linspace(0, 4*np.pi, n)
+        anchors = np.round(np.transpose([ 300*np.cos(u), 200*np.sin(u), 80*u ]))
+        anchors = np.repeat(anchors, rng.integers(1,3,n), axis=0) # double clicks
+        spikes = rng.choice(np.arange(1,anchors.shape[0]-1,3), anchors.shape[0]//100, replace=False)
+        anchors[spikes,:2] += 200
+        start = time(); ref = fix_outliers_loop(clean_up_points_loop(anchors)); t_loop = time()-start
+        start = time(); new = preprocess_anchors(anchors, unwrap_idx=2, outlier_idx=-1); t_vect = time()-start
+        assert np.array_equal(ref, new), 'preprocessing differs from the loop version'
+        # level shift: replacements create new long steps
+        shift = np.c_[np.arange(60.), np.r_[np.zeros(30), np.full(30, 100.)], np.zeros(60)]
+        assert np.array_equal(fix_outliers_loop(shift), fix_outliers(shift)), 'level shift differs from the loop version'
+        # all phases in one call
+        phases = np.concatenate([ np.c_[anchors+ph, np.full(anchors.shape[0], ph)] for ph in range(20) ])
+        start = time(); preprocess_anchors(phases, unwrap_idx=2, outlier_idx=-1, sigma=5, phases=True); t_all = time()-start
+        print('%6d anchors: loop %8.1f ms, vectorized %5.1f ms; 20 phases (+ smoothing) %5.1f ms'%(anchors.shape[0], t_loop*1e3, t_vect*1e3, t_all*1e3))
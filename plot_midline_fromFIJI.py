@@ -7,20 +7,10 @@ Created on Mon Jan  7 15:51:21 2019
 
 import numpy as np
 #import matplotlib as mpl
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-from tqdm import tqdm
-from time import time
-import glob, os, sys
-
-def compute_rot_mat(d,th):
-    ct = np.cos(th)
-    st = np.sin(th)
-    ct_d = 1-ct
-    r1 = np.array( [ ct+d[0]*d[0]*ct_d, d[0]*d[1]*ct_d-d[2]*st, d[0]*d[2]*ct_d+d[1]*st ] )
-    r2 = np.array( [ d[0]*d[1]*ct_d+d[2]*st, ct+d[1]*d[1]*ct_d, d[1]*d[2]*ct_d-d[0]*st ] )
-    r3 = np.array( [ d[0]*d[2]*ct_d-d[1]*st, d[1]*d[2]*ct_d+d[0]*st, ct+d[2]*d[2]*ct_d ] )
-    return np.stack([r1,r2,r3])
+import glob
+import midline_frames as mf
+import geometry as geo
+import coords_io as cio
 
 class Midline(object):
     
@@ -28,23 +18,10 @@ class Midline(object):
         self.coords_file = coords_file
         self.pxlsize = [0.41, 0.41, 2.]
         self.coords_anchors, self.n_points = self.read_file()
+        self.frames = {}
         
     def read_file(self):
-        coords_anchors = []
-
-        with open(self.coords_file) as f:
-            lines = f.readlines()
-            i=0
-            for l in lines:
-                try:
-                    params = np.array( [np.float(v) for v in l.split(",")] )
-                    params *= self.pxlsize
-                    i += 1
-                    # save value as an integer
-                    coords_anchors.append(params)
-                except ValueError:
-                    pass
-        coords_anchors = np.array(coords_anchors)
+        coords_anchors = cio.read_coords(self.coords_file)*self.pxlsize
         n_coords = coords_anchors.shape[0]
         print('#'*40)
         print('N coords:', n_coords)
@@ -54,32 +31,18 @@ class Midline(object):
     
     #%%
     def fix_outliers(self, idx = -1, thr = 2.):
-        # first, fix angles
-        for i in range(self.coords_anchors.shape[0]-1):
-            if np.abs(self.coords_anchors[i+1,2] - self.coords_anchors[i,2])>90:
-                self.coords_anchors[i+1,2] -= 180
-        
-        if idx == -1:
-            diff = np.sqrt(np.diff(self.coords_anchors[:,0])**2+np.diff(self.coords_anchors[:,1])**2)
-        else:
-            diff = np.abs(np.diff(self.coords_anchors[:,idx]))
-        diff_mean = np.mean(diff)
-        print(diff.shape)
-        for i in range(self.n_coords-1):
-            if diff[i]>(thr*diff_mean):
-                print(i, diff[i],diff_mean)
-                for j in range(self.coords_anchors.shape[1]):
-                    self.coords_anchors[i+1,j] = (self.coords_anchors[i,j]+self.coords_anchors[i+2,j])/2
-                diff = np.abs(np.diff(self.coords_anchors[:,idx]))
+        # first, fix angles, then replace the anchors after steps longer than thr times the mean step
+        self.coords_anchors = mf.preprocess_anchors(self.coords_anchors, dedupe=False,
+                                    unwrap_idx=2, outlier_idx=idx, thr=thr)
 
     def smooth_midline(self,sigma=5):
-        from scipy.ndimage import gaussian_filter1d
-        for i in range(self.coords_anchors.shape[1]):
-            self.coords_anchors[:,i] = gaussian_filter1d(self.coords_anchors[:,i], sigma)
+        self.coords_anchors = mf.preprocess_anchors(self.coords_anchors, dedupe=False, sigma=sigma)
 
     #%% 
     def setup_figure(self, figsize=(10,5),viewpoint=(45,60),
         axoff = True):
+        import matplotlib.pyplot as plt
+        from mpl_toolkits.mplot3d import Axes3D # registers the 3d projection
 
         fig = plt.figure(figsize=figsize)
         plt.subplots_adjust(left=0.,bottom=0.,right=1.,top=1.)
@@ -104,46 +67,14 @@ class Midline(object):
 
     def extract_midline_coord_system(self,
                     plot = True, figsize = (10,5), viewpoint=(30,60), vect_length=10, n_vect_show=20, axoff=True,
-                    smooth_order = 100, interp_order=3, method= 'pt'):
+                    smooth_order = 100, interp_order=3, method= 'pt', spacing=1.):
         assert(method in ['fs','pt']), 'Invalid method!'
         centroid = np.copy(self.coords_anchors)
         # print(centroid.shape)
         
-        # # spline interpolation
-        from scipy import interpolate
-        tck, u = interpolate.splprep(np.transpose(centroid), s=smooth_order, k=interp_order)
-        # first, compute a very fine spline
-        u_fine = np.linspace(0,1.,10000)
-        z_fine, y_fine, x_fine = interpolate.splev(u_fine, tck)
-        S = np.transpose( np.array( [z_fine,y_fine,x_fine] ) )
-        spline_length = np.sum(np.linalg.norm(np.diff(S,axis=0),axis=1))
-        print('Spline length with %d points: %.3f'%(10000, spline_length) )
-        n_points_spline = int(spline_length)
-        # then, compute the spline only on the right amount of points, i.e. such that they are homogeneously spaced 1pxl
-        u_fine = np.linspace(0,1.,n_points_spline)
-        z_fine, y_fine, x_fine = interpolate.splev(u_fine, tck)
-        S = np.transpose( np.array( [z_fine,y_fine,x_fine] ) )
-        
-        # Compute all tangents 
-        T = np.gradient(S,edge_order=2,axis=0)
-        T = np.array( [ t/np.linalg.norm(t) for t in T ] )
-
-        if method == 'fs': # frenet-serret frame
-            N = np.gradient(T,edge_order=2,axis=0)
-            N = np.array( [ n/np.linalg.norm(n) for n in N ] )
-
-        elif method == 'pt': # parallel-transported frame, based on https://janakiev.com/blog/framing-parametric-curves/
-            N = np.gradient(T,edge_order=2,axis=0)
-            N = np.array( [ n/np.linalg.norm(n) for n in N ] )
-            for i in range(n_points_spline - 1):
-                b = np.cross(T[i], T[i + 1]) # compute cross product of consecutive tangents
-                b = b / np.linalg.norm(b) # normalize vectore
-                phi = np.arccos(np.dot(T[i], T[i + 1])) # compute angle between consecutive tangent
-                R = compute_rot_mat(b,phi) # compute 3D rotation matrix
-                N[i + 1] = np.dot(R, N[i]) # rotate previous N and save it as current N
-                
-        # Calculate the second normal vector B
-        B = np.array([np.cross(t, n) for (t, n) in zip(T, N)])
+        # splines and frames are computed once per set of anchors and parameters
+        n_points_spline, S, T, N, B = mf.midline_frames(centroid, smooth_order, interp_order, method, spacing,
+                                                         cache=self.frames, verbose=True)
 
         # plot everything
         if plot:
@@ -170,28 +101,6 @@ class Midline(object):
         return n_points_spline, S, T, N, B
 
 
-#%%
-def unit_vector(vector):
-    """ Returns the unit vector of the vector.  """
-    return vector / np.linalg.norm(vector)
-
-def angle_between(v1, v2):
-    """ Returns the angle in radians between vectors 'v1' and 'v2'::
-
-            >>> angle_between((1, 0), (0, 1))
-            1.5707963267948966
-            >>> angle_between((1, 0), (1, 0))
-            0.0
-            >>> angle_between((1, 0), (-1, 0))
-            3.141592653589793
-    """
-    dot = np.dot(v1,v2)
-    det = v1[0]*v2[1]-v1[1]*v2[0]
-    return np.arctan2(det,dot)
-
-def vector(p1,p2):
-    return p2-p1
-
 #%%
 
 class Tethers(object):
@@ -226,13 +135,7 @@ class Tethers(object):
         points = {}
         for chn in self.chamber_idx.keys():
             i = self.chamber_idx[chn]
-            tmp = []
-            with open(self.fList[i]) as f:
-                lines = f.readlines()
-                for l in lines:
-                    v=np.array(l.split(",")).astype(np.float32)
-                    tmp.append(v)
-            tmp = np.array(tmp)
+            tmp = cio.read_coords(self.fList[i], np.float32)
             points[chn] = tmp*self.pxlsize
         
         return points
@@ -244,19 +147,12 @@ class Tethers(object):
         refs = self.xyz_pos['AVCanal']
         for chn in [x for x in self.chamber_idx.keys() if x != 'AVCanal']:
             tethers = self.xyz_pos[chn]
-            data = []
-            if chn == 'Ventricle':
-                vref = vector(refs[2,:2],refs[1,:2])
-            elif chn == 'Atrium':
-                vref = vector(refs[0,:2],refs[1,:2])
-            for t in tethers:
-                if chn == 'Ventricle':
-                    vtet = vector(refs[2,:2],t[:2])
-                elif chn == 'Atrium':
-                    vtet = vector(refs[0,:2],t[:2])
-                theta = angle_between(vref,vtet)*180/np.pi
-                data.append([t[2],theta])
-            zt_pos[chn] = np.array(data)
+            # angles of all the tethers around the Atrium or Ventricle end of the AVCanal
+            origin = refs[2,:2] if chn == 'Ventricle' else refs[0,:2]
+            vref = geo.vector(origin,refs[1,:2])
+            vtet = geo.vector(origin,tethers[:,:2])
+            theta = geo.angle_between(vref,vtet)*180/np.pi
+            zt_pos[chn] = np.stack([tethers[:,2],theta], axis=1)
         return zt_pos
     
     
@@ -265,6 +161,7 @@ class Tethers(object):
     def plot_XY(self, chambers=['Atrium','Ventricle'],
                 xlim=(0,1000), ylim=(0,1000),
                 alpha=0.5, ms=6, marker='o'):
+        import matplotlib.pyplot as plt
         if isinstance(chambers,str): chambers = [chambers]
         chamber_names = list(self.chamber_idx.keys())
         assert all([ch in chamber_names for ch in chambers]), 'Can\'t recognize the chamber!'
@@ -296,6 +193,8 @@ class Tethers(object):
                 xlim=(0,1000), ylim=(0,1000),
                 alpha=0.5, ms=6,
                 plot_midline = False, midline=[],method='pt'):
+        import matplotlib.pyplot as plt
+        from mpl_toolkits.mplot3d import Axes3D # registers the 3d projection
         fig = plt.figure(figsize=(5,5))
         plt.subplots_adjust(left=0.05,bottom=0.05,right=0.95,top=0.95)
         ax = fig.add_subplot(111, projection='3d')
@@ -339,6 +238,7 @@ class Tethers(object):
 
     def plot_ZT_singleChamber(self, chamber,
                               marker='|'):
+        import matplotlib.pyplot as plt
         chamber_names = list(self.chamber_idx.keys())
         assert chamber in chamber_names, 'Can\'t recognize the chamber!'
         assert chamber != 'AVCanal', 'AVCanal is not a chamber!'
@@ -368,6 +268,7 @@ class Tethers(object):
             np.savetxt(outfile+'angles'+chn+'.txt',self.zt_pos[chn])
 
     def project_tethers(self,midline,smooth_order=100,method='pt'):
+        import matplotlib.pyplot as plt
         n_points_spline,S,T,N,B = midline.extract_midline_coord_system(smooth_order=smooth_order, plot=False, method=method)
         t = np.linspace(0,1,n_points_spline)
 
@@ -376,20 +277,11 @@ class Tethers(object):
         plt.figure()
         colors={'Atrium':'#1f77b4','Ventricle':'#ff7f0e'}
         for chamber in ['Atrium','Ventricle']:
-            t_pos[chamber] = []
-            angles[chamber] = []
-            for tether in self.xyz_pos[chamber]:
-                # print(tether)
-                dist = [np.linalg.norm(tether-m) for m in S]
-                i = np.where(dist==np.min(dist))[0][0]
-                t_pos[chamber].append(t[i])
-                angles[chamber].append(angle_between(tether-S[i],N[i])*180/np.pi)
+            t_pos[chamber], angles[chamber], _ = mf.project_points(self.xyz_pos[chamber], S, N, t)
             l,=plt.plot(angles[chamber],t_pos[chamber],'o',color=colors[chamber],ms=2)
 
         # find AVCanal position
-        dist = [np.linalg.norm(self.xyz_pos['AVCanal'][1,:]-m) for m in S]
-        i = np.where(dist==np.min(dist))[0][0]
-        avcanal = t[i]
+        avcanal = mf.project_points(self.xyz_pos['AVCanal'][1,:], S, N, t)[0][0]
         plt.plot([-180,180],[avcanal,avcanal],'-k')
 
         plt.legend(['Atrium','Ventricle','AVCanal'], loc='upper right', fontsize=7)
@@ -397,33 +289,36 @@ class Tethers(object):
         plt.ylabel('Distance along the midline')
 
 
-'''
-The only input needed
-'''
-# paths = [ '180907_kdrlrasCherry_myl7radGFP_001_merged',
-#     '180907_kdrlrasCherry_myl7radGFP_002_merged',
-#     '180914_kdrlrasCherry_mylGFP_ZO1_3_merge',
-#     '180914_kdrlrasCherry_mylGFP_ZO1_4_merge_good',
-#     '180928_kdrlrasCherry_myl7rasGFP_paxillin_2_merge_good',
-#     '180928_kdrlrasCherry_myl7rasGFP_paxillin_3_merge_good',
-#     '180928_kdrlrasCherry_myl7rasGFP_paxillin_4_merge_good',
-#     '181107_kdrlRasCherry_Myl7GFP_phalloidine647_003_merge/try1',
-#     '181107_kdrlRasCherry_Myl7GFP_phalloidine647_003_merge/try2',
-#     '181107_kdrlRasCherry_Myl7GFP_phalloidine647_001_merge/try1',
-#     '181107_kdrlRasCherry_Myl7GFP_phalloidine647_001_merge/try2_better',
-#     ]
+if __name__ == '__main__':
+
+    import matplotlib.pyplot as plt
 
-# path = paths[3]
+    '''
+    The only input needed
+    '''
+    # paths = [ '180907_kdrlrasCherry_myl7radGFP_001_merged',
+    #     '180907_kdrlrasCherry_myl7radGFP_002_merged',
+    #     '180914_kdrlrasCherry_mylGFP_ZO1_3_merge',
+    #     '180914_kdrlrasCherry_mylGFP_ZO1_4_merge_good',
+    #     '180928_kdrlrasCherry_myl7rasGFP_paxillin_2_merge_good',
+    #     '180928_kdrlrasCherry_myl7rasGFP_paxillin_3_merge_good',
+    #     '180928_kdrlrasCherry_myl7rasGFP_paxillin_4_merge_good',
+    #     '181107_kdrlRasCherry_Myl7GFP_phalloidine647_003_merge/try1',
+    #     '181107_kdrlRasCherry_Myl7GFP_phalloidine647_003_merge/try2',
+    #     '181107_kdrlRasCherry_Myl7GFP_phalloidine647_001_merge/try1',
+    #     '181107_kdrlRasCherry_Myl7GFP_phalloidine647_001_merge/try2_better',
+    #     ]
 
+    # path = paths[3]
 
-midline = Midline('test_unwrap_heart/midline_49.txt')
-# midline.fix_outliers(idx=3)
-# midline.smooth_tube(sigma=5)
 
-method = 'pt'
-tethers = Tethers('test_unwrap_heart')
-tethers.project_tethers(midline, method=method)
-tethers.plot_XYZ(xlim=(100,300),ylim=(0,200),plot_midline=True,midline=midline,method=method)
+    midline = Midline('test_unwrap_heart/midline_49.txt')
+    # midline.fix_outliers(idx=2)
+    # midline.smooth_midline(sigma=5)
 
-plt.show()
+    method = 'pt'
+    tethers = Tethers('test_unwrap_heart')
+    tethers.project_tethers(midline, method=method)
+    tethers.plot_XYZ(xlim=(100,300),ylim=(0,200),plot_midline=True,midline=midline,method=method)
 
+    plt.show()
@@ -6,60 +6,33 @@ Created on Mon Jan  7 15:51:21 2019
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-from tqdm import tqdm
-from time import time
-import glob, os, sys, pickle, copy
-
-def vector(p1,p2):
-
-    return p2-p1
-
-def unit_vector(vector):
-    """ Returns the unit vector of the vector.  """
-    return vector / np.linalg.norm(vector)
-
-def angle_between(v1, v2):
-    """ Returns the angle in radians between vectors 'v1' and 'v2'::
-
-            >>> angle_between((1, 0), (0, 1))
-            1.5707963267948966
-            >>> angle_between((1, 0), (1, 0))
-            0.0
-            >>> angle_between((1, 0), (-1, 0))
-            3.141592653589793
-    """
-    dot = np.dot(v1,v2)
-    det = v1[0]*v2[1]-v1[1]*v2[0]
-    return np.arctan2(det,dot)
-
-def compute_rot_mat(d,th):
-    ct = np.cos(th)
-    st = np.sin(th)
-    ct_d = 1-ct
-    r1 = np.array( [ ct+d[0]*d[0]*ct_d, d[0]*d[1]*ct_d-d[2]*st, d[0]*d[2]*ct_d+d[1]*st ] )
-    r2 = np.array( [ d[0]*d[1]*ct_d+d[2]*st, ct+d[1]*d[1]*ct_d, d[1]*d[2]*ct_d-d[0]*st ] )
-    r3 = np.array( [ d[0]*d[2]*ct_d-d[1]*st, d[1]*d[2]*ct_d+d[0]*st, ct+d[2]*d[2]*ct_d ] )
-    return np.stack([r1,r2,r3])
+import pickle
+import midline_frames as mf
 
 class Midline(object):
     
-    def __init__(self, coords_file):
+    def __init__(self, coords_file, coords_anchors=None):
+        # coords_anchors: Midline points already read from coords_file and scaled to the pixel size
         self.coords_file = coords_file
         self.pxlsize = [0.41, 0.41, 2.]
-        pfile = pickle.load(open(coords_file,'rb'))
-        self.coords_anchors = { v[0]: v[1] for v in zip(pfile['_ids'],pfile['coords']) }['Midline']
-        # adjust pixel size
-        if self.coords_anchors.shape[0] > 0:
-            self.coords_anchors[:,0] *= self.pxlsize[0]
-            self.coords_anchors[:,1] *= self.pxlsize[1]
-            self.coords_anchors[:,2] *= self.pxlsize[2]
+        if coords_anchors is None:
+            pfile = pickle.load(open(coords_file,'rb'))
+            self.coords_anchors = { v[0]: v[1] for v in zip(pfile['_ids'],pfile['coords']) }['Midline']
+            # adjust pixel size
+            if self.coords_anchors.shape[0] > 0:
+                self.coords_anchors[:,0] *= self.pxlsize[0]
+                self.coords_anchors[:,1] *= self.pxlsize[1]
+                self.coords_anchors[:,2] *= self.pxlsize[2]
+        else:
+            self.coords_anchors = coords_anchors
         self.coords_anchors = self.clean_up_points()
+        self.frames = {}
         
     #%% 
     def setup_figure(self, figsize=(10,5),viewpoint=(45,60),
         axoff = True):
+        import matplotlib.pyplot as plt
+        from mpl_toolkits.mplot3d import Axes3D # registers the 3d projection
 
         fig = plt.figure(figsize=figsize)
         plt.subplots_adjust(left=0.,bottom=0.,right=1.,top=1.)
@@ -84,7 +57,7 @@ class Midline(object):
 
     def extract_midline_coord_system(self, phase = -1,
                     plot = True, figsize = (10,5), viewpoint=(30,60), vect_length=10, n_vect_show=20, axoff=True,
-                    smooth_order = 100, interp_order=3, method= 'pt'):
+                    smooth_order = 100, interp_order=3, method= 'pt', spacing=1.):
         assert(method in ['fs','pt']), 'Invalid method!'
 
         # select the midline in the specified contraction phase. If not specified, use the first one available
@@ -94,41 +67,9 @@ class Midline(object):
             phase = np.min(centroid[:,3])
         centroid = centroid[centroid[:,3]==phase][:,:3]
         
-        # # spline interpolation
-        from scipy import interpolate
-        tck, u = interpolate.splprep(np.transpose(centroid), s=smooth_order, k=interp_order)
-        # first, compute a very fine spline
-        u_fine = np.linspace(0,1.,10000)
-        z_fine, y_fine, x_fine = interpolate.splev(u_fine, tck)
-        S = np.transpose( np.array( [z_fine,y_fine,x_fine] ) )
-        spline_length = np.sum(np.linalg.norm(np.diff(S,axis=0),axis=1))
-        # print('Spline length with %d points: %.3f'%(10000, spline_length) )
-        n_points_spline = int(spline_length)
-        # then, compute the spline only on the right amount of points, i.e. such that they are homogeneously spaced 1pxl
-        u_fine = np.linspace(0,1.,n_points_spline)
-        z_fine, y_fine, x_fine = interpolate.splev(u_fine, tck)
-        S = np.transpose( np.array( [z_fine,y_fine,x_fine] ) )
-        
-        # Compute all tangents 
-        T = np.gradient(S,edge_order=2,axis=0)
-        T = np.array( [ t/np.linalg.norm(t) for t in T ] )
-
-        if method == 'fs': # frenet-serret frame
-            N = np.gradient(T,edge_order=2,axis=0)
-            N = np.array( [ n/np.linalg.norm(n) for n in N ] )
-
-        elif method == 'pt': # parallel-transported frame, based on https://janakiev.com/blog/framing-parametric-curves/
-            N = np.gradient(T,edge_order=2,axis=0)
-            N = np.array( [ n/np.linalg.norm(n) for n in N ] )
-            for i in range(n_points_spline - 1):
-                b = np.cross(T[i], T[i + 1]) # compute cross product of consecutive tangents
-                b = b / np.linalg.norm(b) # normalize vectore
-                phi = np.arccos(np.dot(T[i], T[i + 1])) # compute angle between consecutive tangent
-                R = compute_rot_mat(b,phi) # compute 3D rotation matrix
-                N[i + 1] = np.dot(R, N[i]) # rotate previous N and save it as current N
-                
-        # Calculate the second normal vector B
-        B = np.array([np.cross(t, n) for (t, n) in zip(T, N)])
+        # splines and frames are computed once per set of anchors and parameters
+        n_points_spline, S, T, N, B = mf.midline_frames(centroid, smooth_order, interp_order, method, spacing,
+                                                         cache=self.frames)
 
         # plot everything
         if plot:
@@ -155,12 +96,18 @@ class Midline(object):
         return n_points_spline, S, T, N, B
 
     def clean_up_points(self):
-        coords = copy.deepcopy(self.coords_anchors)
-        new = np.array([coords[0]])
-        for c in coords[1:]:
-            if any( c!=new[-1] ):
-                new = np.concatenate((new,[c]))
-        return new
+        return mf.remove_duplicates(self.coords_anchors)
+
+    def fix_outliers(self, idx = -1, thr = 2.):
+        # replace the anchors after steps longer than thr times the mean step, in every contraction phase:
+        # steps are measured along x, y or z (idx = 0, 1, 2), or in XY (idx = -1). Unlike the FIJI
+        # midlines, the anchors have no angle column to unwrap
+        assert idx in [-1,0,1,2], 'Invalid column index: use 0, 1 or 2 (x, y, z), or -1 (XY)!'
+        self.coords_anchors = mf.preprocess_anchors(self.coords_anchors, dedupe=False,
+                                    outlier_idx=idx, thr=thr, phases=True)
+
+    def smooth_midline(self, sigma=5):
+        self.coords_anchors = mf.preprocess_anchors(self.coords_anchors, dedupe=False, sigma=sigma, phases=True)
 
 class Tethers(object):
     
@@ -175,12 +122,17 @@ class Tethers(object):
                 self.coords_anchors[_id][:,0] *= self.pxlsize[0]
                 self.coords_anchors[_id][:,1] *= self.pxlsize[1]
                 self.coords_anchors[_id][:,2] *= self.pxlsize[2]
+        # the midline spline of every phase is fitted only once
+        self.midline = Midline(coords_file, coords_anchors=self.coords_anchors['Midline'])
+        self.sap = {}
 
     #%% Plot data in 3D
     
     def plot_XYZ_single_phase(self, phase = -1, chambers=['Atrium','Ventricle'],
                 figure = None, setlims=False, xlim=(0,1000), ylim=(0,1000), alpha=0.5, ms=6,
                 method='pt'):
+        import matplotlib.pyplot as plt
+        from mpl_toolkits.mplot3d import Axes3D # registers the 3d projection
         if phase==-1:
             phase = np.min(self.coords_anchors['Midline'][:,3])
         points_phase = self.filter_points_by_phase(self.coords_anchors,phase=phase)
@@ -209,8 +161,7 @@ class Tethers(object):
                                label=chn)
                 lines.append(l)
 
-        midline = Midline(self.coords_file)
-        n_points_spline,S,T,N,B = midline.extract_midline_coord_system(smooth_order=100, plot=False, method=method)
+        n_points_spline,S,T,N,B = self.midline.extract_midline_coord_system(smooth_order=100, plot=False, method=method)
         show_step = int(n_points_spline/10)
         ax.plot(S[:,0],S[:,1],S[:,2],'-',color='black',lw=2,alpha=.6)
         ax.quiver(S[::show_step,0],S[::show_step,1],S[::show_step,2], 
@@ -231,6 +182,8 @@ class Tethers(object):
         ax.legend(handles=lines)
     
     def plot_XYZ_all_phases(self, method = 'pt'):
+        import matplotlib.pyplot as plt
+        from mpl_toolkits.mplot3d import Axes3D # registers the 3d projection
         phase = set(self.coords_anchors['Midline'][:,3])
 
         fig = plt.figure(figsize=(5,5))
@@ -242,7 +195,8 @@ class Tethers(object):
 
     #%% plot 2D coords
 
-    def plot_SAP_single_phase(self, method = 'pt', phase = -1, figure = None, colors = ['#1f77b4', '#ff7f0e' ], ms=5):
+    def plot_SAP_single_phase(self, method = 'pt', phase = -1, figure = None, colors = ['#1f77b4', '#ff7f0e' ], ms=5, table=None):
+        import matplotlib.pyplot as plt
         if phase==-1:
             phase = np.min(self.coords_anchors['Midline'][:,3])
         points_phase = self.filter_points_by_phase(self.coords_anchors,phase=phase)
@@ -255,7 +209,10 @@ class Tethers(object):
             (fig,ax) = figure
         ax.set_ylim(0,1)
 
-        points_sap = self.extract_tethers2D_single_phase(phase=phase,method=method)
+        if table is None:
+            points_sap = self.extract_tethers2D_single_phase(phase=phase,method=method)
+        else:
+            points_sap = self.sap_single_phase(table,phase)
         # print(points_sap)
 
         for i, ch in enumerate( ['tether_Atrium','tether_Ventricle'] ):
@@ -272,7 +229,9 @@ class Tethers(object):
         plt.ylabel('Distance along the midline')
 
     def plot_SAP_all_phases(self, color_code='phase_dep', method = 'pt'):
+        import matplotlib.pyplot as plt
         phases = set(self.coords_anchors['Midline'][:,3])
+        table = self.extract_SAP_all_phases(method=method)
 
         fig = plt.figure(figsize=(5,5))
         plt.subplots_adjust(left=0.15,bottom=0.15,right=0.95,top=0.95)
@@ -290,11 +249,11 @@ class Tethers(object):
                       ['#332288','#88CCEE','#117733','#DDCC77','#CC6677','#AA4499']]
             colors = colors[len(phases)-1]
             for i, ph in enumerate( phases ):
-                self.plot_SAP_single_phase(method = method, phase=ph, figure=(fig,ax), colors = [colors[i],colors[i]])
+                self.plot_SAP_single_phase(method = method, phase=ph, figure=(fig,ax), colors = [colors[i],colors[i]], table=table)
         elif color_code == 'chamber_dep':
             colors = [ ['#1f77b4', '#ff7f0e' ] for i in range(len(phases)) ]
             for i, ph in enumerate( phases ):
-                self.plot_SAP_single_phase(method = method, phase=ph, figure=(fig,ax), colors = colors[i])
+                self.plot_SAP_single_phase(method = method, phase=ph, figure=(fig,ax), colors = colors[i], table=table)
 
         
        
@@ -317,37 +276,85 @@ class Tethers(object):
         if phase==-1:
             phase = np.min(self.coords_anchors['Midline'][:,3])
 
-        # filter the points in that phase
-        points_phase = self.filter_points_by_phase(self.coords_anchors, phase)
-
-        # compute the midline spline, tangent and normals
-        midline = Midline(self.coords_file)
-        n_points_spline,Spline,T,N,B = midline.extract_midline_coord_system(phase=phase,smooth_order=smooth_order, plot=False, method=method)
-        s = np.linspace(0,1,n_points_spline)
-
-        # compute 2D projection: length along the midline, angle to Normal
+        table = self.extract_SAP_all_phases(phases=[phase],smooth_order=smooth_order,method=method)
+        return self.sap_single_phase(table,phase)
+
+    def extract_SAP_all_phases(self, phases=None, smooth_order=100, method='pt',
+                    objects=['tether_Atrium','tether_Ventricle','AVCanal']):
+        """ Projects the points of all objects, in all contraction phases (with a midline by default), on the midline.
+
+        Returns one structured array with fields phase, object, s (length along the midline, normalized),
+        angle (to the Normal, in degrees), radius (distance from the midline) and x, y, z. Tables are
+        cached, so plotting them again does not project the points again.
+        """
+        if phases is None:
+            phases = sorted(set(self.coords_anchors['Midline'][:,3]))
+        key = (tuple(phases), smooth_order, method, tuple(objects))
+        if key in self.sap:
+            return self.sap[key]
+
+        # midline samples and points of every phase
+        samples, normals, positions, points, phase_idx, labels = [], [], [], [], [], []
+        for k, ph in enumerate( phases ):
+            points_phase = self.filter_points_by_phase(self.coords_anchors, ph)
+            n_points_spline,Spline,T,N,B = self.midline.extract_midline_coord_system(phase=ph,smooth_order=smooth_order, plot=False, method=method)
+            samples.append(np.concatenate([Spline, np.full((n_points_spline,1),k)], axis=1))
+            normals.append(N)
+            positions.append(np.linspace(0,1,n_points_spline))
+            for obj in objects:
+                if points_phase[obj].shape[0] > 0:
+                    points.append(points_phase[obj])
+                    phase_idx.append(np.full(points_phase[obj].shape[0],k))
+                    labels.append(np.full(points_phase[obj].shape[0],obj))
+
+        # the object field fits the longest object id, so that names are never truncated
+        name_len = max([1]+[len(obj) for obj in objects])
+        table = np.zeros(sum(len(l) for l in labels), dtype=[('phase',float),('object','U%d'%name_len),('s',float),('angle',float),
+                                                ('radius',float),('x',float),('y',float),('z',float)])
+        if table.shape[0] == 0:
+            return table
+        P = np.concatenate(points)
+        phase_idx = np.concatenate(phase_idx)
+
+        # project all the points at once: the midlines of different phases are set apart
+        # along a 4th coordinate, further than any distance within a phase
+        S = np.concatenate(samples)
+        offset = 2*np.linalg.norm(np.ptp(np.concatenate([S[:,:3],P]),axis=0))+1
+        S[:,3] *= offset
+        N = np.concatenate([np.concatenate(normals), np.zeros((S.shape[0],1))], axis=1)
+        s, angles, radii = mf.project_points(np.concatenate([P, phase_idx[:,None]*offset], axis=1), S, N, np.concatenate(positions))
+
+        table['phase'] = np.asarray(phases)[phase_idx]
+        table['object'] = np.concatenate(labels)
+        table['s'], table['angle'], table['radius'] = s, angles, radii
+        table['x'], table['y'], table['z'] = P[:,0], P[:,1], P[:,2]
+        self.sap[key] = table
+        return table
+
+    def sap_single_phase(self, table, phase):
+        # points of one phase of a table returned by extract_SAP_all_phases, as [s, angle, phase] per object
         points_sap = {} #s: length along curve, a: alpha, p: phase
         for chamber in ['tether_Atrium','tether_Ventricle','AVCanal']:
-            ps_xyz = points_phase[chamber]
-            ps_surf = []
-            for tether in ps_xyz:
-                dist = [np.linalg.norm(tether-spline) for spline in Spline]
-                i = np.where(dist==np.min(dist))[0][0]
-                ps_surf.append([s[i],angle_between(tether-Spline[i],N[i])*180/np.pi,phase])
-            points_sap[chamber] = np.array(ps_surf)
-
+            rows = table[(table['phase']==phase) & (table['object']==chamber)]
+            if rows.shape[0] == 0:
+                points_sap[chamber] = np.array([])
+            else:
+                points_sap[chamber] = np.stack([rows['s'], rows['angle'], rows['phase']], axis=1)
         return points_sap
 
-# midline = Midline('test_unwrap_heart/5D_merged_points.p')
-# midline.fix_outliers(idx=3)
-# midline.smooth_tube(sigma=5)
-# midline.extract_midline_coord_system()
+if __name__ == '__main__':
+
+    import matplotlib.pyplot as plt
 
-method = 'pt'               # 'fs' OR 'pt'
-color_code = 'phase_dep'    # 'chamber_dep' OR 'phase_dep'
-tethers = Tethers('test_unwrap_heart/5D_merged_small_points.p')
-tethers.plot_XYZ_all_phases(method=method)
-tethers.plot_SAP_all_phases(color_code=color_code, method=method)
+    # midline = Midline('test_unwrap_heart/5D_merged_points.p')
+    # midline.fix_outliers(idx=2)
+    # midline.smooth_midline(sigma=5)
+    # midline.extract_midline_coord_system()
 
-plt.show()
+    method = 'pt'               # 'fs' OR 'pt'
+    color_code = 'phase_dep'    # 'chamber_dep' OR 'phase_dep'
+    tethers = Tethers('test_unwrap_heart/5D_merged_small_points.p')
+    tethers.plot_XYZ_all_phases(method=method)
+    tethers.plot_SAP_all_phases(color_code=color_code, method=method)
 
+    plt.show()